@@ -1,28 +1,48 @@
+"""Recover metadata of removed YouTube videos from their archived copies on
+the Wayback Machine.
+
+Usage:
+  archive.py [--debug] [--shard=<i/N>] [--deadline=<when>] <sourcefn> <targetfn>
+
+Options:
+  --shard=<i/N>        Only process the i-th of N hash partitions of the
+                       videos, counting from 0, writing to a per-shard output
+                       file.
+  --deadline=<when>    Stop starting videos after a duration such as 45m or
+                       2h30m, or at an ISO time such as 2020-05-01T18:00. The
+                       running ones get another minute to finish.
+
+Videos are taken in reverse source order, or highest score first with
+'priority' set, see priority.priority_from_config().
+"""
+
 from common import logger
-from common import config
+from common import config, load_config
+from fetching import (
+    make_session,
+    fetch,
+    concurrency_from_config,
+    timeout_from_config,
+    RateLimiter,
+)
+from cache import cache_from_config
+from checkpoint import checkpoint_from_config
+from output import open_output
+from extractor import ExtractorPool, ScraperError
+from records import ArchiveRecord, SnapshotRecord, is_removal_notice
+from metrics import metrics, timed, exporter_from_config
+from scheduler import bounded_map
+from shard import apply_shard, in_shard
+from priority import priority_from_config, deadline_from_config
+from videoid import watch_url
 
 import os
-import sys
 import re
-
-import pandas as pd
-import numpy as np
-import seaborn as sns
-from tqdm import tqdm
-import csv
+import json
+from urllib.parse import urlencode, urlparse
 
 import aiohttp
 import asyncio
-import requests
-from lxml import html
-
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, RetryError
-from asyncio import TimeoutError
-
-from IPython.core import ultratb
-
-sys.excepthook = ultratb.FormattedTB(mode="Verbose", color_scheme="Linux", call_pdb=1)
-
 
 # Data to be extracted, tuple of XPath and a regexp, applied consecutively
 targets_youtube = {
@@ -113,248 +133,387 @@ targets_archive = {
 }
 
 
-class ScraperError(Exception):
-    pass
-
-
 class InvalidUrl(Exception):
     pass
 
 
-async def get_archive_urls(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            "http://web.archive.org/web/timemap/link/" + url
-        ) as response:
-            resp = await response.text()
-            lines = resp.splitlines()
-            logger.debug("Found %s archive links for %s" % (len(lines[3:]), url))
-            return [
-                str(line)
-                .split(";")[0]
-                .replace("<", "")
-                .replace(">", "")
-                .replace("b'", "")
-                for line in reversed(lines[3:])
-            ]
+class IndexUnavailable(Exception):
+    """The snapshot index didn't answer, e.g. when throttled; the video's
+    captures are unknown rather than absent."""
+
+
+# get_yt_data() result for videos whose archived copies are all removal notices
+REMOVED = "removed"
+
+
+# Set up by configure()
+extractor = None
+cache = None
+controller = None
+timeout = None
+# Parse pages while they download, dropping the rest once the fields are in
+STREAM_PARSE = False
+limiter = RateLimiter()
+ARCHIVE_BASE = "http://web.archive.org"
+# Fetch every snapshot instead of bisecting
+ALL_SNAPSHOTS = False
+# Either "cdx" or "timemap"
+SNAPSHOT_INDEX = "cdx"
+
+
+def configure(config):
+    global extractor, cache, controller, timeout, limiter, STREAM_PARSE
+    global ARCHIVE_BASE, ALL_SNAPSHOTS, SNAPSHOT_INDEX
+    extractor = ExtractorPool(
+        [
+            targets_youtube,
+            targets_youtube_run2,
+            targets_youtube_removed,
+            targets_youtube_removed_run2,
+        ],
+        optional=["subscriberCount"],
+        json_first=config.get("json-extraction", True),
+        workers=config.get("parse-workers", 0),
+        kind=config.get("parse-executor", "process"),
+    )
+    cache = cache_from_config(config)
+    controller = concurrency_from_config(config, config.get("archive-concurrency", 8))
+    timeout = timeout_from_config(config, read_timeout=30)
+    STREAM_PARSE = config.get("stream-parse", STREAM_PARSE)
+    ARCHIVE_BASE = config.get("archive-base", ARCHIVE_BASE)
+    limiter = RateLimiter(
+        {urlparse(ARCHIVE_BASE).hostname: config.get("archive-rate", 5)}
+    )
+    ALL_SNAPSHOTS = config.get("all-snapshots", ALL_SNAPSHOTS)
+    SNAPSHOT_INDEX = config.get("snapshot-index", SNAPSHOT_INDEX)
+
+
+@timed("archive.get_archive_urls")
+async def get_archive_urls(session, url):
+    if SNAPSHOT_INDEX == "timemap":
+        return await get_timemap_urls(session, url)
+    return await get_cdx_urls(session, url)
+
+
+async def get_cdx_urls(session, url):
+    # Only 200 captures, with runs of byte-identical captures collapsed to
+    # their first one, so nothing is fetched twice for the same content
+    cdx_url = (
+        ARCHIVE_BASE
+        + "/cdx/search/cdx?"
+        + urlencode(
+            {
+                "url": url,
+                "output": "json",
+                "fl": "timestamp,original,statuscode,digest,length",
+            }
+        )
+    )
+    status, resp = await fetch(session, cdx_url, cache, limiter, controller)
+    if status != 200:
+        raise IndexUnavailable(status)
+    rows = json.loads(resp) if resp.strip() else []
+    archive_urls = []
+    last_digest = None
+    for row in rows[1:]:
+        capture = dict(zip(rows[0], row))
+        if capture["statuscode"] != "200" or capture["digest"] == last_digest:
+            continue
+        last_digest = capture["digest"]
+        archive_urls.append(
+            "%s/web/%s/%s" % (ARCHIVE_BASE, capture["timestamp"], capture["original"])
+        )
+    logger.debug(
+        "Found %s distinct archive links out of %s for %s"
+        % (len(archive_urls), len(rows[1:]), url)
+    )
+    return list(reversed(archive_urls))
+
+
+async def get_timemap_urls(session, url):
+    timemap_url = ARCHIVE_BASE + "/web/timemap/link/" + url
+    status, resp = await fetch(session, timemap_url, cache, limiter, controller)
+    # The timemap of a URL that was never archived is a 404
+    if status == 404:
+        return []
+    if status != 200:
+        raise IndexUnavailable(status)
+    lines = resp.decode("utf-8").splitlines()
+    logger.debug("Found %s archive links for %s" % (len(lines[3:]), url))
+    return [
+        str(line).split(";")[0].replace("<", "").replace(">", "").replace("b'", "")
+        for line in reversed(lines[3:])
+    ]
 
 
 def scrape_date(archive_url):
-    if not "archive.org" in archive_url:
+    match = re.search("/web/([0-9]{14})", archive_url)
+    if not match:
         return ""
-    return re.search("archive.org\/web\/([0-9]{14})", archive_url).group(1)
+    return match.group(1)
 
 
-async def get_yt_data(youtube_url, archive_urls):
-    logger.debug("Getting YT data for %s, %s links" % (youtube_url, len(archive_urls)))
-    first_removed_url = ""
-    main_data_point = ""
-    all_data_points = []
-    for archive_url in archive_urls:
-        logger.debug("Trying for link related to %s, %s" % (youtube_url, archive_url))
-        try:
-            data = {}
-            data = await scrape(archive_url)
-            data["archiveUrl"] = data["url"]
-            data["url"] = youtube_url
-            # Found video metadata -> not deleted at this stage
-            data["scrapedAt"] = scrape_date(archive_url)
-            if data["title"] and not main_data_point:
-                data["removalAt"] = scrape_date(first_removed_url)
-                # break
-                main_data_point = data
-            # Found removal notification
-            elif data["status"] and not 'status":"OK"' in data["status"]:
-                logger.debug(
-                    "Found removal notice for %s at %s" % (youtube_url, archive_url)
-                )
-                first_removed_url = archive_url
-            all_data_points.append(data)
-        except ScraperError:
-            logger.debug(
-                "Got ScraperError related to %s, for URL %s"
-                % (youtube_url, archive_url)
-            )
-            continue
-        except InvalidUrl:
-            logger.warning("InvalidUrl for %s, %s" % (youtube_url, archive_url))
-            continue
-        except UnicodeDecodeError:
-            logger.warning("UnicodeDecodeError for %s, %s" % (youtube_url, archive_url))
-            continue
-        except (aiohttp.ServerTimeoutError, asyncio.TimeoutError):
-            logger.warning("TimeoutError for %s, %s" % (youtube_url, archive_url))
-            continue
-    if not data or (data["status"] and not data["title"]):
-        logger.warning("Could not find data for %s" % youtube_url)
-    else:
-        if main_data_point:
-            data = main_data_point
-        return {**data, **{"all_archived_data_points": all_data_points}}
-
-
-def valid_url(url):
-    if url == "https://youtube.com/watch?v=":
-        return False
-    if len(url) != 39:
-        return False
-    if "youtube.com/watch" in url or "youtu.be" in url:
-        return True
-    return False
-
-
-def apply_xpath_and_regexp(tree, target):
-    results = {}
-    for title, target in target.items():
-        if not target:
-            results[title] = ""
-            continue
-        xpath, regexp = target
-        data = tree.xpath(
-            xpath, namespaces={"re": "http://exslt.org/regular-expressions"}
-        )
-        if not data:
-            if title == "subscriberCount":
-                data = [""]
-            else:
-                raise ScraperError(
-                    "URL doesn't contain required data on key '%s'" % title
-                )
-        data = data[0]
-        if regexp and data:
-            match = re.search(regexp, data)
-            if not match:
-                raise ScraperError(
-                    "URL doesn't contain matching regexp for key '%s'" % title
-                )
-            data = match.group(0)
-        results[title] = data
-    return results
-
-
-# unused
-async def get_and_extract(url):
+async def get_snapshot(session, youtube_url, archive_url, snapshots=None):
+    """Scrape one archived copy of `youtube_url` into a SnapshotRecord,
+    also writing it to the `snapshots` output if given. Returns None if the
+    copy couldn't be scraped."""
+    logger.debug("Trying for link related to %s, %s" % (youtube_url, archive_url))
     try:
-        return await scrape(url)
-    except ScraperError:
-        logger.warning("Unhandled ScraperError for %s" % url)
+        data = await scrape(session, archive_url)
+    except ScraperError as e:
+        logger.debug(
+            "Got ScraperError related to %s, for URL %s" % (youtube_url, archive_url)
+        )
+        metrics.inc("scraper_errors_total", stage="archive", key=e.key)
         return None
     except InvalidUrl:
-        logger.warning("InvalidUrl for %s" % url)
-        return None
-    except (
-        concurrent.futures._base.TimeoutError,
-        aiohttp.ServerTimeoutError,
-        aiohttp.TimeoutError,
-        asyncio.TimeoutError,
-    ):
-        logger.warning("TimeoutError for %s" % url)
+        logger.warning("InvalidUrl for %s, %s" % (youtube_url, archive_url))
         return None
     except UnicodeDecodeError:
-        logger.warning("UnicodeDecodeError for %s" % url)
+        logger.warning("UnicodeDecodeError for %s, %s" % (youtube_url, archive_url))
         return None
+    except (aiohttp.ServerTimeoutError, asyncio.TimeoutError):
+        logger.warning("TimeoutError for %s, %s" % (youtube_url, archive_url))
+        return None
+    except aiohttp.ClientError as e:
+        logger.warning("%s for %s, %s" % (type(e).__name__, youtube_url, archive_url))
+        return None
+    snapshot = SnapshotRecord(
+        data,
+        url=youtube_url,
+        archiveUrl=archive_url,
+        scrapedAt=scrape_date(archive_url),
+    )
+    if snapshots is not None:
+        snapshots.write(snapshot)
+    return snapshot
+
+
+@timed("archive.get_yt_data")
+async def get_yt_data(session, youtube_url, archive_urls, snapshots=None):
+    """Return the ArchiveRecord of `youtube_url`, REMOVED if the archived
+    copies found are all removal notices, or None if none could be scraped.
+    Every snapshot scraped on the way is written to the `snapshots` output
+    as it comes in, if given."""
+    logger.debug("Getting YT data for %s, %s links" % (youtube_url, len(archive_urls)))
+    if ALL_SNAPSHOTS:
+        return await get_yt_data_all(session, youtube_url, archive_urls, snapshots)
+    return await get_yt_data_bisect(session, youtube_url, archive_urls, snapshots)
 
 
-async def scrape(url):
-    async with aiohttp.ClientSession(read_timeout=30) as session:
-        async with session.get(url) as response:
-            if response.status == 404:
-                raise InvalidUrl
-            data = extract_targets_from_page(
-                await response.text(),
-                [
-                    targets_youtube,
-                    targets_youtube_run2,
-                    targets_youtube_removed,
-                    targets_youtube_removed_run2,
-                ],
+async def get_yt_data_all(session, youtube_url, archive_urls, snapshots=None):
+    first_removed_url = ""
+    main_data_point = None
+    data = None
+    for archive_url in archive_urls:
+        snapshot = await get_snapshot(session, youtube_url, archive_url, snapshots)
+        if snapshot is None:
+            continue
+        data = snapshot
+        # Found video metadata -> not deleted at this stage
+        if data.title and not main_data_point:
+            main_data_point = ArchiveRecord(
+                data, removalAt=scrape_date(first_removed_url)
             )
-            return {**data, **{"url": url}}
-
-
-@retry(stop=stop_after_attempt(2), retry=retry_if_exception_type(ScraperError))
-def extract_targets_from_page(pagecontent, targets):
-    tree = html.fromstring(pagecontent)
-    if isinstance(targets, dict):
-        targets = [targets]
-
-    for idx, target in enumerate(targets):
-        try:
-            data = apply_xpath_and_regexp(tree, target)
-            break
-        except ScraperError as e:
-            if idx + 1 == len(targets):
-                raise ScraperError(e)
-            else:
-                continue
-    return data
-
+        # Found removal notification
+        elif is_removal_notice(data):
+            logger.debug(
+                "Found removal notice for %s at %s" % (youtube_url, archive_url)
+            )
+            first_removed_url = archive_url
+    if main_data_point is None and first_removed_url:
+        logger.debug("Only found removal notices for %s" % youtube_url)
+        return REMOVED
+    if not data or (data.status and not data.title):
+        logger.warning("Could not find data for %s" % youtube_url)
+        return None
+    return main_data_point or ArchiveRecord(data)
 
-def get_yt_link(x):
-    try:
-        m = re.search("(v\=|youtu.be/)([a-zA-Z0-9_\-]+)", x)
-    except TypeError:
-        return ""
-    if not m:
-        return x
-    return "https://youtube.com/watch?v=" + m.groups()[1]
 
+async def get_yt_data_bisect(session, youtube_url, archive_urls, snapshots=None):
+    # Snapshots are time-ordered and a video never comes back once removed,
+    # so bisect for the first removal notice instead of fetching every
+    # snapshot. archive_urls is newest first.
+    archive_snapshots = list(reversed(archive_urls))
+    probed = {}
 
-def get_yt_id(x):
-    try:
-        m = re.search("(v\=|youtu.be/)([a-zA-Z0-9_\-]+)", x)
-    except TypeError:
-        return ""
-    if not m:
-        return ""
-    return m.groups()[1]
-
-
-sourcefn = sys.argv[1]
-targetfn = sys.argv[2]
+    async def probe(idx):
+        if idx not in probed:
+            probed[idx] = await get_snapshot(
+                session, youtube_url, archive_snapshots[idx], snapshots
+            )
+        return probed[idx]
+
+    lo, hi = 0, len(archive_snapshots)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # Step past snapshots that can't be classified either way
+        idx, data = mid, None
+        while idx < hi:
+            data = await probe(idx)
+            if data and (data.title or is_removal_notice(data)):
+                break
+            idx += 1
+        if idx == hi:
+            hi = mid
+        elif data.title:
+            lo = idx + 1
+        else:
+            hi = idx
+
+    live = [i for i, data in probed.items() if data and data.title]
+    if not live:
+        if any(data and is_removal_notice(data) for data in probed.values()):
+            logger.debug("Only found removal notices for %s" % youtube_url)
+            return REMOVED
+        logger.warning("Could not find data for %s" % youtube_url)
+        return None
+    last_live = max(live)
+    removed = [
+        i
+        for i, data in probed.items()
+        if data and i > last_live and is_removal_notice(data)
+    ]
+    removal_at = ""
+    if removed:
+        first_removed_url = archive_snapshots[min(removed)]
+        logger.debug(
+            "Found removal notice for %s at %s" % (youtube_url, first_removed_url)
+        )
+        removal_at = scrape_date(first_removed_url)
+    return ArchiveRecord(probed[last_live], removalAt=removal_at)
+
+
+@timed("archive.scrape")
+async def scrape(session, url):
+    stream = extractor.stream() if STREAM_PARSE else None
+    status, body = await fetch(session, url, cache, limiter, controller, stream)
+    if status == 404:
+        raise InvalidUrl
+    if stream is not None:
+        data = await extractor.extract_stream(stream, body)
+    else:
+        data = await extractor.extract(body)
+    return data
 
-df = pd.read_csv(sourcefn)
-urls = list(df["url"].unique())
-fields = (
-    ["url"]
-    + list(targets_youtube.keys())
-    + ["scrapedAt", "removalAt", "archiveUrl", "all_archived_data_points"]
-)
 
-if os.path.isfile(targetfn):
+async def archive_video(session, url, snapshots=None):
+    """Archive `url`, returning (url, outcome, data) with data None on failure."""
     try:
-        current_data = pd.read_csv(targetfn)
-        read_urls = current_data["url"].values
-    except pd.errors.EmptyDataError:
-        read_urls = []
-else:
-    read_urls = []
-    # headers
-    with open(targetfn, "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(fields)
-
-BATCHSIZE = 8
-loop = asyncio.get_event_loop()
-
-with open(targetfn, "a") as f:
-    writer = csv.writer(f)
-    for url_range in tqdm(reversed(range(0, len(urls), BATCHSIZE))):
-        url_batch = urls[url_range : url_range + BATCHSIZE]
-        url_batch = [
-            url for url in url_batch if url not in read_urls and valid_url(url)
-        ]
-        if not url_batch:
-            continue
-        coroutines = [get_archive_urls(url) for url in url_batch]
-        results = loop.run_until_complete(asyncio.gather(*coroutines))
-
-        coroutines = [
-            get_yt_data(yt_url, archive_urls)
-            for yt_url, archive_urls in zip(url_batch, results)
-            if archive_urls
-        ]
-        results = loop.run_until_complete(asyncio.gather(*coroutines))
-
-        for data in [res for res in results if res]:
-            writer.writerow([data[x] for x in fields])
\ No newline at end of file
+        archive_urls = await get_archive_urls(session, url)
+    except IndexUnavailable as e:
+        logger.warning("Snapshot index answered %s for %s" % (e.args[0], url))
+        return url, "error", None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # ValueError covers malformed or undecodable index responses
+        logger.warning(
+            "%s fetching the snapshot index for %s" % (type(e).__name__, url)
+        )
+        return url, "error", None
+    if not archive_urls:
+        return url, "invalid", None
+    data = await get_yt_data(session, url, archive_urls, snapshots)
+    if data is REMOVED:
+        outcome, data = "removed", None
+    else:
+        outcome = "ok" if data else "error"
+    metrics.inc("outcomes_total", stage="archive", outcome=outcome)
+    return url, outcome, data
+
+
+async def archive_all(urls, output, snapshots, checkpoint, concurrency, deadline=None):
+    from tqdm import tqdm
+
+    async with make_session(concurrency, timeout=timeout) as session:
+        progress = tqdm(total=len(urls))
+        async for url, outcome, data in bounded_map(
+            lambda url: archive_video(session, url, snapshots),
+            urls,
+            concurrency,
+            deadline,
+        ):
+            progress.update()
+            if data:
+                output.write(data)
+            checkpoint.record(url, outcome)
+        progress.close()
+
+
+def main(argv=None):
+    from ingest import iter_video_ids
+
+    load_config(__doc__, argv)
+    shard = apply_shard(config)
+    configure(config)
+    exporter = exporter_from_config(config)
+    deadline = deadline_from_config(config)
+    sourcefn = config["sourcefn"]
+    targetfn = config["targetfn"]
+
+    # One canonical URL per video, whichever form of link each row has
+    urls = [
+        watch_url(yt_id)
+        for yt_id in iter_video_ids(
+            sourcefn, "url", config.get("ingest-chunksize", 100000)
+        )
+    ]
+    row_group_size = config.get("row-group-size", 10000)
+    normalize = config.get("normalize", False)
+    output = open_output(
+        targetfn,
+        list(ArchiveRecord.__slots__),
+        row_group_size=row_group_size,
+        normalize=normalize,
+    )
+    # Every archived copy scraped, one row each, next to the main output
+    root, ext = os.path.splitext(targetfn.rstrip("/"))
+    snapshots = open_output(
+        config.get("snapshots-fn") or root + ".snapshots" + ext,
+        list(SnapshotRecord.__slots__),
+        row_group_size=row_group_size,
+        normalize=normalize,
+    )
+
+    def flush():
+        snapshots.flush()
+        output.flush()
+
+    checkpoint = checkpoint_from_config(
+        config,
+        "archive",
+        targetfn,
+        commit_every=output.flush_every,
+        before_commit=flush,
+    )
+
+    urls = [
+        url
+        for url in reversed(urls)
+        if (shard is None or in_shard(url, shard)) and url not in checkpoint
+    ]
+    order = priority_from_config(config, sourcefn)
+    if order is not None:
+        urls = order(urls)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        archive_all(
+            urls,
+            output,
+            snapshots,
+            checkpoint,
+            config.get("archive-concurrency", 8),
+            deadline,
+        )
+    )
+    checkpoint.close()
+    output.close()
+    snapshots.close()
+    extractor.shutdown()
+    if cache is not None:
+        cache.close()
+    exporter.close()
+
+
+if __name__ == "__main__":
+    main()
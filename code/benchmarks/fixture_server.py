@@ -0,0 +1,253 @@
+"""Local stand-in for YouTube watch pages and oEmbed, the Wayback Machine and
+the Graph API, replaying the recorded pages in fixtures/.
+
+Whether a video is removed, and whether its pages use the old or the new
+layout, is derived from a hash of its ID, so every run serves the same
+answers. Archived videos have a series of snapshots that switch from the
+live page to the removal notice two thirds of the way through, with runs of
+identical captures and a few redirects in the CDX index.
+
+Usage:
+  fixture_server.py [options]
+
+Options:
+  --port=<port>              Port to listen on [default: 8765].
+  --latency=<ms>             Mean added response latency [default: 0].
+  --jitter=<ms>              Standard deviation of the latency [default: 0].
+  --error-rate=<p>           Share of requests answered with a 503 [default: 0].
+  --empty-share=<p>          Share of watch pages and snapshots answered with
+                             an empty body, alternately as a 200 and a 503
+                             [default: 0].
+  --removed-share=<p>        Share of watch pages that are removed [default: 0.1].
+  --old-share=<p>            Share of videos with old-layout pages [default: 0.3].
+  --snapshots=<n>            Archived snapshots per video [default: 60].
+  --page-kb=<kb>             Filler added to every watch page, split between
+                             its head and the end of its body [default: 400].
+  --rate-limit-share=<p>     Share of Graph requests that hit the rate limit [default: 0].
+  --bandwidth=<kbps>         Rate each watch page is sent at in KB/s, 0 for
+                             unlimited [default: 0].
+"""
+
+import asyncio
+import json
+import os
+import random
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+
+from aiohttp import web
+from docopt import docopt
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIRST_SNAPSHOT = datetime(2020, 1, 1)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def fraction(video_id, salt):
+    return zlib.crc32((salt + video_id).encode("utf-8")) / 2**32
+
+
+class FixtureServer:
+    def __init__(
+        self,
+        latency=0,
+        jitter=0,
+        error_rate=0,
+        empty_share=0,
+        removed_share=0.1,
+        old_share=0.3,
+        snapshots=60,
+        page_kb=400,
+        rate_limit_share=0,
+        bandwidth=0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.empty_share = empty_share
+        self.removed_share = removed_share
+        self.old_share = old_share
+        self.snapshots = snapshots
+        self.rate_limit_share = rate_limit_share
+        self.bandwidth = bandwidth
+        self.stats = Counter()
+        # Real pages carry scripts and styles both before and after the data
+        filler = '<script>var filler = "%s";</script>' % ("x" * 512 * page_kb)
+        self.pages = {
+            name: load_fixture(name + ".html")
+            .replace("<!--FILLER-->", filler)
+            .replace("<!--TRAILER-->", filler)
+            for name in ("watch_new", "watch_old", "watch_removed", "watch_removed_old")
+        }
+        self.oembed_page = load_fixture("oembed.json")
+        self.graph = {
+            name: json.loads(load_fixture(name + ".json"))
+            for name in ("graph_engagement", "graph_rate_limit", "graph_invalid")
+        }
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/watch", self.watch)
+        app.router.add_get("/oembed", self.oembed)
+        app.router.add_get("/web/timemap/link/{url:.*}", self.timemap)
+        app.router.add_get("/cdx/search/cdx", self.cdx)
+        app.router.add_get(r"/web/{timestamp:\d{14}}/{url:.*}", self.snapshot)
+        app.router.add_route("*", "/v7.0/", self.graph_api)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path == "/stats":
+            return await handler(request)
+        self.stats["requests"] += 1
+        if self.latency or self.jitter:
+            delay = random.gauss(self.latency, self.jitter) / 1000
+            await asyncio.sleep(max(0, delay))
+        if random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        return await handler(request)
+
+    async def watch_page(self, request, video_id, removed):
+        if random.random() < self.empty_share:
+            self.stats["empty"] += 1
+            return web.Response(status=503 if self.stats["empty"] % 2 else 200)
+        old = fraction(video_id, "layout") < self.old_share
+        if removed:
+            name = "watch_removed_old" if old else "watch_removed"
+        else:
+            name = "watch_old" if old else "watch_new"
+        body = self.pages[name].replace("VIDEO_ID", video_id).encode("utf-8")
+        if not self.bandwidth:
+            self.stats["bytes_sent"] += len(body)
+            return web.Response(body=body, content_type="text/html")
+        response = web.StreamResponse(headers={"Content-Type": "text/html"})
+        response.content_length = len(body)
+        await response.prepare(request)
+        chunk = 16 * 1024
+        for start in range(0, len(body), chunk):
+            await asyncio.sleep(chunk / 1024 / self.bandwidth)
+            try:
+                await response.write(body[start : start + chunk])
+            except ConnectionError:
+                # The client dropped the rest of the page
+                return response
+            self.stats["bytes_sent"] += len(body[start : start + chunk])
+        await response.write_eof()
+        return response
+
+    async def watch(self, request):
+        self.stats["watch"] += 1
+        video_id = request.query.get("v", "")
+        return await self.watch_page(
+            request, video_id, fraction(video_id, "removed") < self.removed_share
+        )
+
+    async def oembed(self, request):
+        self.stats["oembed"] += 1
+        video_id = request.query.get("url", "").rsplit("v=", 1)[-1]
+        if len(video_id) != 11:
+            return web.Response(status=400, text="Bad Request")
+        if fraction(video_id, "removed") < self.removed_share:
+            return web.Response(status=404, text="Not Found")
+        return web.Response(
+            text=self.oembed_page.replace("VIDEO_ID", video_id),
+            content_type="application/json",
+        )
+
+    def captures(self, url):
+        """(timestamp, statuscode, digest) of the archived copies of `url`."""
+        removal = 2 * self.snapshots // 3
+        captures = []
+        for idx in range(self.snapshots):
+            timestamp = FIRST_SNAPSHOT + timedelta(hours=50 * idx)
+            status = "302" if idx % 7 == 3 else "200"
+            # Identical captures in runs of 5 while live, all identical once removed
+            digest = "REMOVED" if idx >= removal else "LIVE%s" % (idx // 5)
+            captures.append((timestamp.strftime("%Y%m%d%H%M%S"), status, digest))
+        return captures
+
+    async def timemap(self, request):
+        self.stats["timemap"] += 1
+        url = request.match_info["url"]
+        base = "%s://%s" % (request.scheme, request.host)
+        lines = [
+            '<%s>; rel="original",' % url,
+            '<%s/web/timemap/link/%s>; rel="self"; type="application/link-format",'
+            % (base, url),
+            '<%s>; rel="timegate",' % base,
+        ]
+        for timestamp, _, _ in self.captures(url):
+            lines.append('<%s/web/%s/%s>; rel="memento",' % (base, timestamp, url))
+        return web.Response(text="\n".join(lines))
+
+    async def cdx(self, request):
+        self.stats["cdx"] += 1
+        url = request.query["url"]
+        rows = [["timestamp", "original", "statuscode", "digest", "length"]]
+        for timestamp, status, digest in self.captures(url):
+            rows.append([timestamp, url, status, digest, "12345"])
+        return web.json_response(rows)
+
+    async def snapshot(self, request):
+        self.stats["snapshot"] += 1
+        url = request.match_info["url"]
+        video_id = url.rsplit("v=", 1)[-1]
+        removal = self.captures(url)[2 * self.snapshots // 3][0]
+        return await self.watch_page(
+            request, video_id, request.match_info["timestamp"] >= removal
+        )
+
+    def engagement(self, url):
+        if random.random() < self.rate_limit_share:
+            self.stats["graph_rate_limited"] += 1
+            return self.graph["graph_rate_limit"], 403
+        if not url:
+            return self.graph["graph_invalid"], 400
+        return {**self.graph["graph_engagement"], "id": url}, 200
+
+    async def graph_api(self, request):
+        self.stats["graph"] += 1
+        usage = {"call_count": 10, "total_cputime": 5, "total_time": 5}
+        headers = {"X-App-Usage": json.dumps(usage)}
+        form = await request.post()
+        if "batch" in form:
+            items = []
+            for item in json.loads(form["batch"]):
+                query = parse_qs(item["relative_url"].split("?", 1)[-1])
+                data, code = self.engagement(query.get("id", [""])[0])
+                items.append({"code": code, "body": json.dumps(data)})
+            return web.json_response(items, headers=headers)
+        data, code = self.engagement(request.query.get("id", ""))
+        return web.json_response(data, status=code, headers=headers)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+
+def main():
+    args = docopt(__doc__)
+    server = FixtureServer(
+        latency=float(args["--latency"]),
+        jitter=float(args["--jitter"]),
+        error_rate=float(args["--error-rate"]),
+        empty_share=float(args["--empty-share"]),
+        removed_share=float(args["--removed-share"]),
+        old_share=float(args["--old-share"]),
+        snapshots=int(args["--snapshots"]),
+        page_kb=int(args["--page-kb"]),
+        rate_limit_share=float(args["--rate-limit-share"]),
+        bandwidth=float(args["--bandwidth"]),
+    )
+    web.run_app(server.app(), host="127.0.0.1", port=int(args["--port"]), print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Offline benchmarks of the scrapers against the local fixture server.
+
+Reports, per scenario, records/sec, requests per useful record and the
+peak RSS of the scenario, plus that of its largest parse worker if any.
+Each scenario runs in its own process, so the figures are comparable. The
+parse scenario reports the time to extract the fields from each recorded
+page, without any network.
+
+Usage:
+  replay.py [options] [<scenario>...]
+
+Scenarios: parse, youtube, archive, graph. All of them run by default.
+
+Options:
+  --videos=<n>             Videos (or URLs for graph) per scenario [default: 200].
+  --concurrency=<n>        Requests in flight [default: 32].
+  --parse-workers=<n>      Parse worker processes, 0 parses inline [default: 0].
+  --snapshot-index=<kind>  cdx or timemap [default: cdx].
+  --all-snapshots          Fetch every snapshot instead of bisecting.
+  --stream-parse           Parse pages while they download.
+  --triage                 Probe the oEmbed stand-in before fetching watch pages.
+  --latency=<ms>           Mean server latency [default: 20].
+  --jitter=<ms>            Standard deviation of the latency [default: 5].
+  --error-rate=<p>         Share of requests answered with a 503 [default: 0.01].
+  --empty-share=<p>        Share of pages answered with an empty body [default: 0.01].
+  --rate-limit-share=<p>   Share of Graph requests rate limited [default: 0.02].
+  --page-kb=<kb>           Filler added to every watch page [default: 400].
+  --bandwidth=<kbps>       Rate each watch page is sent at in KB/s [default: 0].
+  --snapshots=<n>          Archived snapshots per video [default: 60].
+  --repeats=<n>            Extractions per page in the parse scenario [default: 20].
+  --port=<port>            Port for the fixture server [default: 8765].
+"""
+
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from docopt import docopt
+
+from common import logger
+from scheduler import bounded_map
+from fetching import make_session
+
+SCENARIOS = ["parse", "youtube", "archive", "graph"]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def video_ids(count):
+    return ["fixture%04d" % idx for idx in range(count)]
+
+
+def report(name, records, seconds, requests=None, extra=""):
+    line = "%-10s %6s records %8.1f rec/s" % (name, records, records / seconds)
+    if requests is not None:
+        line += " %6.2f req/rec" % (requests / max(records, 1))
+    line += " %7.1f MB peak RSS" % peak_rss_mb()
+    # Parse workers have exited by now; the fixture server hasn't
+    workers = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    if workers:
+        line += " (%.1f MB per worker)" % workers
+    print(line + extra)
+
+
+class ServerProcess:
+    def __init__(self, args):
+        self.base = "http://127.0.0.1:%s" % args["--port"]
+        options = [
+            "--port",
+            "--latency",
+            "--jitter",
+            "--error-rate",
+            "--empty-share",
+            "--rate-limit-share",
+            "--page-kb",
+            "--bandwidth",
+            "--snapshots",
+        ]
+        self.command = [sys.executable, os.path.join(BENCH_DIR, "fixture_server.py")]
+        self.command += ["%s=%s" % (option, args[option]) for option in options]
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.command)
+        for _ in range(100):
+            try:
+                self.stats()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Fixture server didn't start")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+    def stats(self):
+        with urllib.request.urlopen(self.base + "/stats") as response:
+            return json.loads(response.read())
+
+    def requests(self):
+        return self.stats().get("requests", 0)
+
+
+def bench_parse(args):
+    import youtube
+    from extractor import Extractor
+    from fixture_server import FixtureServer
+
+    pages = FixtureServer(page_kb=int(args["--page-kb"])).pages
+    target_sets = [
+        youtube.targets_youtube,
+        youtube.targets_youtube_run2,
+        youtube.targets_youtube_removed,
+        youtube.targets_youtube_removed_run2,
+    ]
+    repeats = int(args["--repeats"])
+    for json_first in (True, False):
+        extractor = Extractor(target_sets, json_first=json_first)
+        for name, page in pages.items():
+            body = page.encode("utf-8")
+            start = time.perf_counter()
+            for _ in range(repeats):
+                extractor.extract(body)
+            micros = 1e6 * (time.perf_counter() - start) / repeats
+            mode = "json" if json_first else "xpath"
+            print("parse      %-18s %-5s %10.0f us/page" % (name, mode, micros))
+
+
+async def bench_youtube(args, server):
+    import youtube
+
+    youtube.configure(
+        {
+            "parse-workers": int(args["--parse-workers"]),
+            "json-extraction": True,
+            "stream-parse": args["--stream-parse"],
+            "triage-url": args["--triage"] and server.base + "/oembed?url={url}",
+        }
+    )
+    concurrency = int(args["--concurrency"])
+    urls = [
+        server.base + "/watch?v=" + video_id
+        for video_id in video_ids(int(args["--videos"]))
+    ]
+    requests = server.requests()
+    records = 0
+    start = time.perf_counter()
+    async with make_session(concurrency) as session:
+        async for url, outcome, data in bounded_map(
+            lambda url: youtube.async_scrape(session, url), urls, concurrency
+        ):
+            records += data is not None
+    seconds = time.perf_counter() - start
+    youtube.extractor.shutdown()
+    report("youtube", records, seconds, server.requests() - requests)
+
+
+async def bench_archive(args, server):
+    import archive
+
+    archive.configure(
+        {
+            "archive-base": server.base,
+            "archive-rate": 0,
+            "parse-workers": int(args["--parse-workers"]),
+            "snapshot-index": args["--snapshot-index"],
+            "all-snapshots": args["--all-snapshots"],
+            "stream-parse": args["--stream-parse"],
+        }
+    )
+    concurrency = int(args["--concurrency"])
+    urls = [
+        "https://youtube.com/watch?v=" + video_id
+        for video_id in video_ids(int(args["--videos"]))
+    ]
+    requests = server.requests()
+    records = 0
+    start = time.perf_counter()
+    async with make_session(concurrency, read_timeout=30) as session:
+        async for url, outcome, data in bounded_map(
+            lambda url: archive.archive_video(session, url), urls, concurrency
+        ):
+            records += data is not None
+    seconds = time.perf_counter() - start
+    archive.extractor.shutdown()
+    report("archive", records, seconds, server.requests() - requests)
+
+
+def bench_graph(args, server):
+    from concurrent.futures import ThreadPoolExecutor
+    from graphclient import GraphClient, FAILED, MAX_BATCH_SIZE
+
+    concurrency = int(args["--concurrency"])
+    client = GraphClient(
+        ["token-a", "token-b", "token-c"],
+        pool_size=concurrency,
+        cooldown=0.5,
+        graph_url=server.base + "/v7.0/",
+    )
+    urls = [
+        "https://youtube.com/watch?v=" + video_id
+        for video_id in video_ids(int(args["--videos"]))
+    ]
+    batches = [
+        urls[i : i + MAX_BATCH_SIZE] for i in range(0, len(urls), MAX_BATCH_SIZE)
+    ]
+    requests = server.requests()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(client.get_engagement_many, batches))
+    seconds = time.perf_counter() - start
+    records = sum(data not in (None, FAILED) for batch in results for data in batch)
+    report("graph", records, seconds, server.requests() - requests)
+
+
+def main():
+    args = docopt(__doc__)
+    scenarios = args["<scenario>"] or SCENARIOS
+    if len(scenarios) > 1:
+        options = [
+            key if value is True else "%s=%s" % (key, value)
+            for key, value in args.items()
+            if key.startswith("--") and value not in (None, False)
+        ]
+        for scenario in scenarios:
+            subprocess.run([sys.executable, __file__] + options + [scenario])
+        return
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+
+    if "parse" in scenarios:
+        bench_parse(args)
+    if not set(scenarios) - {"parse"}:
+        return
+    with ServerProcess(args) as server:
+        loop = asyncio.new_event_loop()
+        if "youtube" in scenarios:
+            loop.run_until_complete(bench_youtube(args, server))
+        if "archive" in scenarios:
+            loop.run_until_complete(bench_archive(args, server))
+        if "graph" in scenarios:
+            bench_graph(args, server)
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Measure how long it takes to import each pipeline module in a fresh
+interpreter, which is the start-up cost of every script and worker process.
+
+Usage:
+  python benchmarks/startup.py [<repeats>]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["extractor", "youtube", "archive", "facebook_graph_api"]
+
+
+def time_import(module, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "import " + module], cwd=CODE_DIR, check=True
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    baseline = statistics.median(time_import("sys", repeats))
+    print("%-20s %10s %10s" % ("module", "median ms", "import ms"))
+    print("%-20s %10.1f %10s" % ("(interpreter)", 1000 * baseline, "-"))
+    for module in MODULES:
+        median = statistics.median(time_import(module, repeats))
+        print(
+            "%-20s %10.1f %10.1f" % (module, 1000 * median, 1000 * (median - baseline))
+        )
+
+
+if __name__ == "__main__":
+    main()
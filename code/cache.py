@@ -0,0 +1,173 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import zlib
+
+# Wayback snapshots addressed by a full timestamp never change
+IMMUTABLE_URL = re.compile(r"web\.archive\.org/web/[0-9]{14}/")
+
+
+class ResponseCache:
+    """Compressed on-disk cache of page bodies, keyed on URL.
+
+    Bodies are stored zlib-compressed in files named after the SHA-1 of the
+    URL, with an SQLite index tracking size and last access. When the total
+    size exceeds `max_bytes` the least recently used entries are evicted.
+    Immutable Wayback snapshots never expire, other pages (live YouTube
+    pages, timemaps) expire after `live_ttl` seconds.
+
+    Several processes, such as the shards of a run, can share a directory:
+    the total size is kept in the index rather than per process, so
+    `max_bytes` holds for all of them together. Access times are written
+    in batches of `touch_every` hits, so a hit is only a file read.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=10 * 2**30,
+        live_ttl=7 * 24 * 3600,
+        touch_every=100,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.live_ttl = live_ttl
+        self.touch_every = touch_every
+        self.accessed = {}
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=30)
+        # WAL lets shards read while another one writes, and with NORMAL
+        # commits don't wait for an fsync
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, status INTEGER, size INTEGER, "
+            "stored_at REAL, accessed_at REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS usage "
+            "(id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)"
+        )
+        # Caches from before the usage table start from their entries
+        self.db.execute(
+            "INSERT OR IGNORE INTO usage "
+            "SELECT 0, COALESCE(SUM(size), 0) FROM entries"
+        )
+        self.db.commit()
+
+    @property
+    def total_bytes(self):
+        return self.db.execute("SELECT total FROM usage").fetchone()[0]
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _expired(self, url, stored_at):
+        if IMMUTABLE_URL.search(url):
+            return False
+        return self.live_ttl is not None and time.time() - stored_at > self.live_ttl
+
+    def get(self, url):
+        """Return (status, body) for a cached URL, or None on a miss."""
+        key = self._key(url)
+        row = self.db.execute(
+            "SELECT status, stored_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if not row:
+            return None
+        status, stored_at = row
+        if self._expired(url, stored_at):
+            self._remove(key)
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                body = zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            self._remove(key)
+            return None
+        self.accessed[key] = time.time()
+        if len(self.accessed) >= self.touch_every:
+            self._touch()
+        return status, body
+
+    def _touch(self):
+        """Write the buffered access times."""
+        self.db.executemany(
+            "UPDATE entries SET accessed_at = ? WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in self.accessed.items()],
+        )
+        self.db.commit()
+        self.accessed = {}
+
+    def put(self, url, status, body):
+        key = self._key(url)
+        body = zlib.compress(body)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body)
+        self._forget(key)
+        now = time.time()
+        self.db.execute(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+            (key, status, len(body), now, now),
+        )
+        self.db.execute("UPDATE usage SET total = total + ?", (len(body),))
+        self.db.commit()
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _forget(self, key):
+        row = self.db.execute(
+            "SELECT size FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.db.execute("UPDATE usage SET total = total - ?", (row[0],))
+
+    def _remove(self, key):
+        self._forget(key)
+        self.db.commit()
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Trim to 90% so that eviction doesn't run on every put once full
+        self._touch()
+        excess = self.total_bytes - self.max_bytes * 0.9
+        rows = self.db.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at"
+        ).fetchall()
+        for key, size in rows:
+            if excess <= 0:
+                break
+            excess -= size
+            self._forget(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        self.db.commit()
+
+    def close(self):
+        self._touch()
+        self.db.close()
+
+
+def cache_from_config(config):
+    """Build the ResponseCache configured under 'cache-dir', or None if caching is off."""
+    if not config.get("cache-dir"):
+        return None
+    return ResponseCache(
+        config["cache-dir"],
+        max_bytes=config.get("cache-max-bytes", 10 * 2**30),
+        live_ttl=config.get("cache-live-ttl", 7 * 24 * 3600),
+    )
@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import time
+
+from videoid import video_key
+
+OUTCOMES = ("ok", "removed", "invalid", "error")
+# Outcomes that count as done; errors are retried on the next run
+DONE = ("ok", "removed", "invalid")
+
+
+class Checkpoint:
+    """On-disk record of which videos a stage has processed, and how.
+
+    Keyed on (stage, video ID) in SQLite, so lookups are index hits and a
+    restart doesn't need to read the output back. Several stages can share
+    one file. Records are committed every `commit_every` calls, after
+    calling `before_commit` (e.g. flushing the output file) so that nothing
+    is checkpointed before its output row is on disk.
+
+    `key` maps URLs to the key they're recorded under, the video ID by
+    default so that every form of link to a video counts as the same one.
+    """
+
+    def __init__(
+        self, path, stage, commit_every=100, before_commit=None, key=video_key
+    ):
+        self.stage = stage
+        self.key = key
+        self.commit_every = commit_every
+        self.before_commit = before_commit
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS progress "
+            "(stage TEXT, video_id TEXT, outcome TEXT, updated_at REAL, "
+            "PRIMARY KEY (stage, video_id))"
+        )
+        self.db.commit()
+
+    def __contains__(self, url):
+        return self.outcome(url) in DONE
+
+    def __len__(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM progress WHERE stage = ?", (self.stage,)
+        ).fetchone()[0]
+
+    def outcome(self, url):
+        row = self.db.execute(
+            "SELECT outcome FROM progress WHERE stage = ? AND video_id = ?",
+            (self.stage, self.key(url)),
+        ).fetchone()
+        return row[0] if row else None
+
+    def record(self, url, outcome):
+        assert outcome in OUTCOMES
+        self.db.execute(
+            "INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?)",
+            (self.stage, self.key(url), outcome, time.time()),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.db.commit()
+        self.uncommitted = 0
+
+    def seed_from_csv(self, csvfn, column="url"):
+        """Import the URLs of an output file written before checkpointing existed."""
+        if len(self) or not os.path.isfile(csvfn):
+            return
+        import pandas as pd
+
+        try:
+            urls = pd.read_csv(csvfn, usecols=[column])[column]
+        except (pd.errors.EmptyDataError, ValueError):
+            return
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?)",
+            ((self.stage, self.key(url), "ok", now) for url in urls.dropna()),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def checkpoint_from_config(config, stage, targetfn, **kwargs):
+    path = config.get("checkpoint") or targetfn + ".checkpoint"
+    checkpoint = Checkpoint(path, stage, **kwargs)
+    checkpoint.seed_from_csv(targetfn)
+    return checkpoint
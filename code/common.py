@@ -1,22 +1,38 @@
+import os
 import sys
 from loguru import logger
-import yaml
-from docopt import docopt
 
-with open("config.yaml", "r") as conf, open("secret.yaml", "r") as secr:
-    config = yaml.safe_load(conf) or {}
-    secret_config = yaml.safe_load(secr) or {}
-cli_args = {}
-if (
-    sys.modules["__main__"].__package__ is None
-    or "pytest" not in sys.modules["__main__"].__package__
-):
-    cli_args = docopt(
-        sys.modules["__main__"].__doc__, version="telegram_collection 0.1"
-    )
-    cli_args = {
-        k.replace("-", "").replace("<", "").replace(">", ""): v
-        for k, v in cli_args.items()
-        if "-" in k or "<" in k
-    }
-config = {**config, **secret_config, **cli_args}
\ No newline at end of file
+# Filled in by load_config() when a script starts, so that importing a module
+# doesn't read config files or parse the command line
+config = {}
+
+
+def load_config(doc=None, argv=None):
+    """Merge config.yaml, secret.yaml and the command line parsed against the
+    usage string `doc` into `config`, and return it."""
+    import yaml
+    from docopt import docopt
+
+    file_config, secret_config = {}, {}
+    if os.path.isfile("config.yaml"):
+        with open("config.yaml", "r") as conf:
+            file_config = yaml.safe_load(conf) or {}
+    if os.path.isfile("secret.yaml"):
+        with open("secret.yaml", "r") as secr:
+            secret_config = yaml.safe_load(secr) or {}
+    cli_args = {}
+    if doc:
+        cli_args = docopt(doc, argv=argv, version="telegram_collection 0.1")
+        cli_args = {
+            k.replace("-", "").replace("<", "").replace(">", ""): v
+            for k, v in cli_args.items()
+            if ("-" in k or "<" in k) and v is not None and v is not False
+        }
+    config.update({**file_config, **secret_config, **cli_args})
+    if config.get("debug"):
+        from IPython.core import ultratb
+
+        sys.excepthook = ultratb.FormattedTB(
+            mode="Verbose", color_scheme="Linux", call_pdb=1
+        )
+    return config
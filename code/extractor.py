@@ -0,0 +1,489 @@
+import asyncio
+import codecs
+import json
+import multiprocessing
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from lxml import etree, html
+
+from metrics import metrics
+
+REGEXP_NAMESPACES = {"re": "http://exslt.org/regular-expressions"}
+
+# Assignments of the embedded JSON blobs, in both the current layout and the
+# older ytplayer.config layout where the player response is a JSON string.
+# Starting on the names rather than on the "var "/"window[" before them lets
+# the regex engine skip ahead to candidates, which is an order of magnitude
+# faster on multi-MB pages; blob_name() checks what comes before.
+JSON_BLOB = re.compile(
+    r'(ytInitialPlayerResponse|ytInitialData|ytplayer\.config)(?:"\])?\s*=\s*'
+)
+json_decoder = json.JSONDecoder()
+
+
+class ScraperError(Exception):
+    """A page lacks the data required on `key`."""
+
+    def __init__(self, message, key=""):
+        super().__init__(message)
+        self.key = key
+
+    def __reduce__(self):
+        # Keep the key when raised in a worker process
+        return ScraperError, (str(self), self.key)
+
+
+def compile_targets(targets, optional=()):
+    """Compile a target dict of key -> (xpath, regexp) into a list of
+    (key, XPath, compiled regexp, optional) tuples. Keys with an empty
+    target compile to (key, None, None, False) and always extract to "".
+    """
+    compiled = []
+    for key, target in targets.items():
+        if not target:
+            compiled.append((key, None, None, False))
+            continue
+        xpath, regexp = target
+        compiled.append(
+            (
+                key,
+                etree.XPath(xpath, namespaces=REGEXP_NAMESPACES),
+                re.compile(regexp) if regexp else None,
+                key in optional,
+            )
+        )
+    return compiled
+
+
+def parse_html(pagecontent):
+    """Parse a page into an lxml tree, failing on "document" when the page
+    is empty, as error answers and zero-length captures are."""
+    try:
+        return html.fromstring(pagecontent)
+    except etree.ParserError:
+        raise ScraperError("Empty page", key="document") from None
+
+
+def apply_targets(tree, targets):
+    results = {}
+    for key, xpath, regexp, optional in targets:
+        if xpath is None:
+            results[key] = ""
+            continue
+        data = xpath(tree)
+        if not data:
+            if optional:
+                data = [""]
+            else:
+                raise ScraperError(
+                    "URL doesn't contain required data on key '%s'" % key, key
+                )
+        data = data[0]
+        if regexp is not None and data:
+            match = regexp.search(data)
+            if not match:
+                raise ScraperError(
+                    "URL doesn't contain matching regexp for key '%s'" % key, key
+                )
+            data = match.group(0)
+        if isinstance(data, str):
+            # Plain str drops the smart string's reference to the tree
+            data = str(data)
+        results[key] = data
+    return results
+
+
+def blob_name(pagecontent, match):
+    """Name of the blob assigned at a JSON_BLOB match, or None if it isn't
+    an assignment of the blob itself."""
+    name = match.group(1)
+    if name == "ytplayer.config":
+        return "config"
+    start = match.start()
+    if pagecontent.endswith("var ", 0, start) or pagecontent.endswith(
+        'window["', 0, start
+    ):
+        return name
+    return None
+
+
+def find_json_blobs(pagecontent):
+    """Decode the embedded player response and initial data in one pass over the page."""
+    blobs = {}
+    for match in JSON_BLOB.finditer(pagecontent):
+        name = blob_name(pagecontent, match)
+        if name is None or name in blobs:
+            continue
+        try:
+            blobs[name], _ = json_decoder.raw_decode(pagecontent, match.end())
+        except ValueError:
+            continue
+        if "ytInitialPlayerResponse" in blobs and "ytInitialData" in blobs:
+            break
+    return player_from_config(blobs)
+
+
+def player_from_config(blobs):
+    """Fall back on the player response embedded in an old-layout ytplayer.config."""
+    if "ytInitialPlayerResponse" not in blobs and "config" in blobs:
+        try:
+            blobs["ytInitialPlayerResponse"] = json.loads(
+                blobs["config"]["args"]["player_response"]
+            )
+        except (KeyError, TypeError, ValueError):
+            pass
+    return blobs
+
+
+def text_of(obj):
+    if not obj:
+        return ""
+    if "simpleText" in obj:
+        return obj["simpleText"]
+    return "".join(run.get("text", "") for run in obj.get("runs", []))
+
+
+def video_renderers(initial_data):
+    primary, secondary = {}, {}
+    try:
+        contents = initial_data["contents"]["twoColumnWatchNextResults"]["results"][
+            "results"
+        ]["contents"]
+    except (KeyError, TypeError):
+        return primary, secondary
+    for item in contents:
+        primary = item.get("videoPrimaryInfoRenderer", primary)
+        secondary = item.get("videoSecondaryInfoRenderer", secondary)
+    return primary, secondary
+
+
+def extract_json_fields(pagecontent):
+    return json_fields(find_json_blobs(pagecontent))
+
+
+def json_fields(blobs):
+    player = blobs.get("ytInitialPlayerResponse")
+    if not isinstance(player, dict):
+        raise ScraperError(
+            "URL doesn't contain ytInitialPlayerResponse", "ytInitialPlayerResponse"
+        )
+    playability = player.get("playabilityStatus", {})
+    details = player.get("videoDetails", {})
+    if playability.get("status") == "OK" and not details:
+        raise ScraperError(
+            "URL doesn't contain required data on key 'videoDetails'", "videoDetails"
+        )
+    microformat = player.get("microformat", {}).get("playerMicroformatRenderer", {})
+    primary, secondary = video_renderers(blobs.get("ytInitialData"))
+    owner = secondary.get("owner", {}).get("videoOwnerRenderer", {})
+
+    status = ""
+    if playability.get("status") != "OK":
+        status = json.dumps(
+            {k: playability[k] for k in ("status", "reason") if k in playability},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+    duration = ""
+    if details.get("lengthSeconds"):
+        duration = "PT%sS" % details["lengthSeconds"]
+    return {
+        "status": status,
+        "title": details.get("title", ""),
+        "description": details.get("shortDescription", ""),
+        "publishedAt": text_of(primary.get("dateText"))
+        or microformat.get("publishDate", ""),
+        "viewCount": details.get("viewCount", ""),
+        "channelId": details.get("channelId", ""),
+        "duration": duration,
+        "channelUrl": microformat.get("ownerProfileUrl", ""),
+        "subscriberCount": text_of(owner.get("subscriberCountText")),
+    }
+
+
+class Extractor:
+    """Applies an ordered list of target sets to a page, compiled once up front.
+
+    The page is parsed once and each target set is tried against the same
+    tree in turn, the first one that fully matches wins. `optional` names
+    keys that extract to "" instead of failing when their XPath is empty.
+
+    With `json_first`, fields are first read from the page's embedded
+    ytInitialPlayerResponse/ytInitialData JSON, and the target sets are only
+    used as a fallback for old-layout pages that don't carry it.
+    """
+
+    def __init__(self, target_sets, optional=(), json_first=False):
+        self.target_sets = [
+            compile_targets(targets, optional) for targets in target_sets
+        ]
+        self.keys = list(target_sets[0].keys())
+        self.json_first = json_first
+
+    def extract(self, pagecontent):
+        if isinstance(pagecontent, bytes):
+            pagecontent = pagecontent.decode("utf-8")
+        if self.json_first:
+            try:
+                with metrics.timer("extract", method="json"):
+                    return self.fields(extract_json_fields(pagecontent))
+            except ScraperError:
+                pass
+        with metrics.timer("html_parse"):
+            tree = parse_html(pagecontent)
+        return self.extract_tree(tree)
+
+    def fields(self, values):
+        return {key: values.get(key, "") for key in self.keys}
+
+    def stream(self):
+        return StreamingExtraction(self)
+
+    def extract_tree(self, tree):
+        with metrics.timer("extract", method="xpath"):
+            for idx, targets in enumerate(self.target_sets):
+                try:
+                    return apply_targets(tree, targets)
+                except ScraperError:
+                    if idx + 1 == len(self.target_sets):
+                        raise
+
+
+def is_complete(value):
+    """Whether the parser is done with the element holding an XPath result,
+    i.e. a later element has been started after it."""
+    element = value if isinstance(value, etree._Element) else value.getparent()
+    while element is not None:
+        if element.getnext() is not None:
+            return True
+        element = element.getparent()
+    return False
+
+
+def resolved(tree, targets):
+    """Whether every target has a complete match in a partially parsed tree."""
+    for key, xpath, regexp, optional in targets:
+        if xpath is None:
+            continue
+        data = xpath(tree)
+        if not data or not is_complete(data[0]):
+            return False
+    return True
+
+
+class JsonScan:
+    """Finds and decodes the embedded JSON blobs of a page fed in pieces.
+
+    A blob is decoded once the end of its <script> has arrived, the first
+    decodable occurrence of each name wins, as in find_json_blobs().
+    """
+
+    # Longest text a JSON_BLOB match can span
+    OVERLAP = 64
+
+    def __init__(self):
+        self.buffer = ""
+        self.scanned = 0
+        self.pending = []
+        self.blobs = {}
+
+    def feed(self, text):
+        self.buffer += text
+        for match in JSON_BLOB.finditer(self.buffer, self.scanned):
+            if match.end() == len(self.buffer):
+                # The blob's first character hasn't arrived yet
+                self.scanned = match.start()
+                break
+            self.scanned = match.end()
+            name = blob_name(self.buffer, match)
+            if name is None or name in self.blobs:
+                continue
+            if name not in dict(self.pending):
+                self.pending.append((name, match.end()))
+        else:
+            self.scanned = max(self.scanned, len(self.buffer) - self.OVERLAP)
+        self.decode(final=False)
+
+    def decode(self, final):
+        pending = []
+        for name, start in self.pending:
+            if not final and self.buffer.find("</script>", start) == -1:
+                pending.append((name, start))
+                continue
+            try:
+                self.blobs[name], _ = json_decoder.raw_decode(self.buffer, start)
+            except ValueError:
+                pass
+        self.pending = pending
+
+    def finish(self):
+        self.decode(final=True)
+        return player_from_config(self.blobs)
+
+
+class StreamingExtraction:
+    """Extracts the fields of one page from its body as it downloads.
+
+    feed() takes the next chunk of bytes and returns True once the fields
+    are known, so the rest of the download can be dropped:
+
+    - with `json_first`, when the page's player response has been decoded
+      along with its initial data, or on its own when the video isn't
+      playable (only the status matters then)
+    - otherwise, when every target of the first target set has a complete
+      match in the partially parsed tree. Later target sets are only
+      tried on the full page, as an earlier set may still match further on.
+
+    result() returns those fields, or extracts them from everything fed so
+    far when no early result was found, as Extractor.extract() would.
+    """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.fed = False
+        self.data = None
+        self.scan = None
+        self.parser = None
+        self.tree = None
+        if extractor.json_first:
+            self.scan = JsonScan()
+        else:
+            self.parser = etree.HTMLPullParser(events=("start",))
+
+    def feed(self, chunk):
+        self.fed = True
+        text = self.decoder.decode(chunk)
+        if self.scan is not None:
+            self.scan.feed(text)
+            self.check_json()
+        else:
+            self.parser.feed(text)
+            self.check_tree()
+        return self.data is not None
+
+    def check_json(self):
+        player = self.scan.blobs.get("ytInitialPlayerResponse")
+        if not isinstance(player, dict):
+            return
+        playable = player.get("playabilityStatus", {}).get("status") == "OK"
+        if playable and "ytInitialData" not in self.scan.blobs:
+            return
+        try:
+            self.data = self.extractor.fields(json_fields(self.scan.blobs))
+        except ScraperError:
+            pass
+
+    def check_tree(self):
+        for _, element in self.parser.read_events():
+            if self.tree is None:
+                self.tree = element.getroottree().getroot()
+        if self.tree is None or self.data is not None:
+            return
+        targets = self.extractor.target_sets[0]
+        if resolved(self.tree, targets):
+            try:
+                self.data = apply_targets(self.tree, targets)
+            except ScraperError:
+                pass
+
+    def result(self):
+        if self.data is not None:
+            return self.data
+        text = self.decoder.decode(b"", final=True)
+        if self.scan is not None:
+            self.scan.feed(text)
+            try:
+                return self.extractor.fields(json_fields(self.scan.finish()))
+            except ScraperError:
+                pass
+            with metrics.timer("html_parse"):
+                tree = parse_html(self.scan.buffer)
+        else:
+            self.parser.feed(text)
+            tree = self.parser.close()
+            if tree is None:
+                raise ScraperError("Empty page", key="document")
+        return self.extractor.extract_tree(tree)
+
+
+# Each worker thread or process builds its own Extractor, as compiled XPath
+# evaluators can't be shared between threads
+worker = threading.local()
+
+
+def init_worker(target_sets, optional, json_first):
+    worker.extractor = Extractor(target_sets, optional, json_first)
+
+
+def extract_in_worker(pagecontent):
+    return worker.extractor.extract(pagecontent)
+
+
+class ExtractorPool:
+    """Runs Extractor.extract off the event loop.
+
+    With `workers` > 0, pages are parsed in a pool of `kind` "process" or
+    "thread" workers; only the raw page bytes go in and the small dict of
+    extracted fields comes out. With 0 workers, pages are parsed inline.
+
+    The parse and extraction timings of Extractor are only recorded for
+    inline and thread workers; extract_seconds covers every page, including
+    the time spent waiting for a worker.
+    """
+
+    def __init__(
+        self, target_sets, optional=(), json_first=False, workers=0, kind="process"
+    ):
+        self.extractor = Extractor(target_sets, optional, json_first)
+        self.executor = None
+        if kind == "thread" and workers:
+            self.executor = ThreadPoolExecutor(
+                workers,
+                initializer=init_worker,
+                initargs=(target_sets, list(optional), json_first),
+            )
+        elif workers:
+            # Workers start from a fresh interpreter rather than a fork, which
+            # could copy a lock held by the metrics exporter or tqdm threads
+            self.executor = ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(target_sets, list(optional), json_first),
+            )
+
+    async def extract(self, pagecontent):
+        with metrics.timer("extract", method="pool"):
+            if self.executor is None:
+                return self.extractor.extract(pagecontent)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, extract_in_worker, pagecontent
+            )
+
+    def stream(self):
+        return self.extractor.stream()
+
+    async def extract_stream(self, stream, pagecontent):
+        """Fields of a page fed to `stream` as it downloaded, or of
+        `pagecontent` if it wasn't streamed (e.g. on a cache hit).
+
+        Pages streamed to the end without an early result are finished
+        inline, re-using what was parsed while downloading, unless there
+        are pool workers to extract them from scratch.
+        """
+        if stream.data is not None:
+            metrics.inc("stream_pages_total", result="early")
+            return stream.data
+        if stream.fed and self.executor is None:
+            metrics.inc("stream_pages_total", result="full")
+            with metrics.timer("extract", method="stream"):
+                return stream.result()
+        return await self.extract(pagecontent)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
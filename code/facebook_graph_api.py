@@ -1,38 +1,119 @@
-import sys
-import os
-
-import pandas as pd
-import numpy as np
-from tqdm import tqdm
-import csv
-
-from graphclient import GraphClient
-from common import config
-
-sourcefn = sys.argv[1]
-targetfn = sys.argv[2]
-
-links = pd.read_csv(sourcefn)
-
-urls = list(links["url"].values)
-
-client = GraphClient(config["graph-tokens"])
-
-current_data = pd.read_csv(targetfn)
-read_urls = current_data["yt_link"].values
-
-with open(targetfn, "a") as f:
-    writer = csv.writer(f)
-    fields = [
-        "url",
-        "reaction_count",
-        "comment_count",
-        "share_count",
-        "comment_plugin_count",
-    ]
-    for url in tqdm(urls):
-        if url in read_urls:
-            continue
-        data = client.get_engagement(url)
-        if data is not None:
-            writer.writerow([data[x] for x in fields])
+"""Look up the Facebook engagement of each URL through the Graph API.
+
+Usage:
+  facebook_graph_api.py [--debug] [--shard=<i/N>] [--refresh] <sourcefn> <targetfn>
+
+Options:
+  --shard=<i/N>  Only process the i-th of N hash partitions of the URLs,
+                 counting from 0, writing to a per-shard output file. Combine
+                 the shards with merge.py --by-url.
+  --refresh      Keep the engagement history of each URL in <targetfn>, an
+                 SQLite database, re-querying only the URLs last observed
+                 more than refresh-ttl seconds ago, fastest growing first.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from graphclient import GraphClient, FAILED, GRAPH_URL, MAX_BATCH_SIZE
+from checkpoint import checkpoint_from_config
+from history import EngagementHistory
+from output import open_output
+from common import config, load_config
+from metrics import exporter_from_config
+from shard import apply_shard, in_shard
+
+fields = [
+    "url",
+    "reaction_count",
+    "comment_count",
+    "share_count",
+    "comment_plugin_count",
+]
+
+# Re-query URLs after a week by default in --refresh mode
+REFRESH_TTL = 7 * 24 * 3600
+
+
+def main(argv=None):
+    import pandas as pd
+    from tqdm import tqdm
+
+    load_config(__doc__, argv)
+    shard = apply_shard(config)
+    sourcefn = config["sourcefn"]
+    targetfn = config["targetfn"]
+    exporter = exporter_from_config(config)
+
+    links = pd.read_csv(sourcefn)
+
+    # Rows without a URL would be queried, and stored in the history under
+    # NULL, on every run
+    urls = [url for url in links["url"].dropna() if isinstance(url, str)]
+
+    batch_size = config.get("graph-batch-size", MAX_BATCH_SIZE)
+    concurrency = config.get("graph-concurrency", len(config["graph-tokens"]))
+
+    client = GraphClient(
+        config["graph-tokens"],
+        pool_size=concurrency,
+        usage_threshold=config.get("graph-usage-threshold", 90),
+        graph_url=config.get("graph-url", GRAPH_URL),
+    )
+
+    urls = [url for url in urls if shard is None or in_shard(url, shard)]
+    if config.get("refresh"):
+        history = EngagementHistory(targetfn)
+        urls = history.due(urls, config.get("refresh-ttl", REFRESH_TTL))
+        if config.get("refresh-max-urls"):
+            urls = urls[: config["refresh-max-urls"]]
+
+        def record(url, data):
+            # Failed URLs aren't observed, so they stay due
+            if data is not FAILED:
+                history.record(url, data)
+
+        closing = [history]
+    else:
+        output = open_output(
+            targetfn,
+            fields,
+            types={field: "int64" for field in fields[1:]},
+            row_group_size=config.get("row-group-size", 10000),
+        )
+        checkpoint = checkpoint_from_config(
+            config,
+            "engagement",
+            targetfn,
+            commit_every=output.flush_every,
+            before_commit=output.flush,
+            # Engagement is per exact URL, not per video
+            key=str,
+        )
+        urls = [url for url in urls if url not in checkpoint]
+
+        def record(url, data):
+            if data is FAILED:
+                checkpoint.record(url, "error")
+            elif data is not None:
+                output.write(data)
+                checkpoint.record(url, "ok")
+            else:
+                checkpoint.record(url, "invalid")
+
+        closing = [checkpoint, output]
+
+    batches = [urls[i : i + batch_size] for i in range(0, len(urls), batch_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch, results in zip(
+            batches,
+            tqdm(executor.map(client.get_engagement_many, batches), total=len(batches)),
+        ):
+            for url, data in zip(batch, results):
+                record(url, data)
+    for closable in closing:
+        closable.close()
+    exporter.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import asyncio
+import collections
+import contextlib
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+from metrics import metrics
+
+
+def make_session(
+    concurrency=32, connections_per_host=0, read_timeout=None, timeout=None
+):
+    """Create one long-lived, connection-pooled session to be shared by all scrapes.
+
+    `connections_per_host` of 0 means no per-host cap beyond `concurrency`.
+    `timeout` defaults to aiohttp's (300s per request, 30s to connect) with
+    `read_timeout` as the limit between reads.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        limit_per_host=connections_per_host,
+        ttl_dns_cache=300,
+    )
+    if timeout is None:
+        timeout = make_timeout(read_timeout=read_timeout)
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, trace_configs=[connect_tracing()]
+    )
+
+
+def make_timeout(total=300, connect=30, read_timeout=None):
+    return aiohttp.ClientTimeout(
+        total=total, sock_connect=connect, sock_read=read_timeout
+    )
+
+
+def timeout_from_config(config, read_timeout=None):
+    """Timeout configured under 'request-timeout', 'connect-timeout' and
+    'read-timeout', in seconds."""
+    return make_timeout(
+        config.get("request-timeout", 300),
+        config.get("connect-timeout", 30),
+        config.get("read-timeout", read_timeout),
+    )
+
+
+def connect_tracing():
+    """Trace config observing the time spent opening new connections."""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_start(session, context, params):
+        context.connect_start = time.perf_counter()
+
+    async def on_end(session, context, params):
+        metrics.observe("connect_seconds", time.perf_counter() - context.connect_start)
+
+    trace_config.on_connection_create_start.append(on_start)
+    trace_config.on_connection_create_end.append(on_end)
+    return trace_config
+
+
+class TokenBucket:
+    """Async token bucket handing out `rate` tokens per second, at most `burst` at once."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Keeps one TokenBucket per host.
+
+    `rates` maps hostnames to requests per second, hosts not listed fall back
+    to `default_rate`. A rate of None leaves the host unthrottled.
+    """
+
+    def __init__(self, rates=None, default_rate=None, burst=1):
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.burst = burst
+        self.buckets = {}
+
+    async def acquire(self, url):
+        host = urlparse(url).hostname
+        rate = self.rates.get(host, self.default_rate)
+        if not rate:
+            return
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(rate, self.burst)
+        await self.buckets[host].acquire()
+
+
+# Failures that mean the host is overloaded or throttling us
+CONGESTION_ERRORS = (
+    aiohttp.ServerDisconnectedError,
+    aiohttp.ServerTimeoutError,
+    asyncio.TimeoutError,
+)
+
+
+def is_congested(status):
+    return status == 429 or status >= 500
+
+
+class HostConcurrency:
+    """Adaptive limit on the requests in flight to one host."""
+
+    def __init__(self, host, limit, min_limit, max_limit):
+        self.host = host
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        # Smoothed time to the response headers, and the lowest it has been
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0
+        self.report()
+
+    def report(self):
+        metrics.set("concurrency_limit", int(self.limit), host=self.host)
+        metrics.set("in_flight", self.in_flight, host=self.host)
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                raise
+        self.in_flight += 1
+        self.report()
+
+    def release(self):
+        self.in_flight -= 1
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+        self.report()
+
+    def healthy(self, latency, increase, tolerance):
+        if self.latency is None:
+            self.latency = latency
+        self.latency = 0.9 * self.latency + 0.1 * latency
+        self.baseline = min(self.baseline or self.latency, self.latency)
+        if self.latency <= tolerance * self.baseline:
+            # Grows by `increase` once every `limit` healthy responses
+            self.limit = min(self.max_limit, self.limit + increase / self.limit)
+            self.report()
+
+    def congested(self, reason, backoff):
+        # Responses to requests sent before the last cut report congestion
+        # too, so cut at most once per round trip
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * backoff)
+        metrics.inc("concurrency_decreases_total", host=self.host, reason=reason)
+        self.report()
+
+
+class AdaptiveConcurrency:
+    """AIMD control of the requests in flight, kept separately per host.
+
+    Each host starts at `initial` concurrent requests. The limit grows by
+    `increase` per round trip while the smoothed time to the response
+    headers stays within `tolerance` times the lowest seen, holds while
+    responses are slower than that, and is multiplied by `backoff` on 429
+    and 5xx responses, timeouts and dropped connections. It stays between
+    `min_limit` and `max_limit`. The current limits are reported as the
+    concurrency_limit metric.
+    """
+
+    def __init__(
+        self,
+        initial=4,
+        min_limit=1,
+        max_limit=32,
+        increase=1,
+        backoff=0.5,
+        tolerance=2.0,
+    ):
+        self.initial = min(initial, max_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.hosts = {}
+
+    def host(self, url):
+        host = urlparse(url).hostname
+        if host not in self.hosts:
+            self.hosts[host] = HostConcurrency(
+                host, self.initial, self.min_limit, self.max_limit
+            )
+        return self.hosts[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        """Hold one of the host's slots for a request.
+
+        The caller sets `status` and `latency` on the yielded slot once the
+        response headers are in.
+        """
+        host = self.host(url)
+        await host.acquire()
+        slot = Slot()
+        try:
+            yield slot
+        except CONGESTION_ERRORS as e:
+            host.congested(type(e).__name__, self.backoff)
+            raise
+        finally:
+            host.release()
+        if slot.status is not None and is_congested(slot.status):
+            host.congested(str(slot.status), self.backoff)
+        elif slot.latency is not None:
+            host.healthy(slot.latency, self.increase, self.tolerance)
+
+
+class Slot:
+    __slots__ = ("status", "latency")
+
+    def __init__(self):
+        self.status = None
+        self.latency = None
+
+
+def concurrency_from_config(config, max_limit):
+    """AdaptiveConcurrency capped at `max_limit`, or None with
+    'adaptive-concurrency' turned off."""
+    if not config.get("adaptive-concurrency", True):
+        return None
+    return AdaptiveConcurrency(
+        initial=config.get("initial-concurrency", 4),
+        max_limit=max_limit,
+        backoff=config.get("concurrency-backoff", 0.5),
+        tolerance=config.get("latency-tolerance", 2.0),
+    )
+
+
+# Size of the pieces a streamed body is read in
+STREAM_CHUNK = 64 * 1024
+
+
+async def fetch(
+    session, url, cache=None, limiter=None, concurrency=None, consumer=None
+):
+    """GET `url` through the cache, rate limiter and AdaptiveConcurrency if
+    given, returning (status, body).
+
+    With a `consumer`, the body of a 200 response is fed to
+    consumer.feed() in chunks as it arrives, and the download is dropped as
+    soon as feed() returns True. The body returned is then what was read up
+    to that point, and isn't cached.
+
+    Records the time to the response headers (including any connection
+    setup) and the body download separately, per host.
+    """
+    host = urlparse(url).hostname
+    if cache is not None:
+        hit = cache.get(url)
+        metrics.inc("cache_total", result="miss" if hit is None else "hit")
+        if hit is not None:
+            return hit
+    if limiter is not None:
+        with metrics.timer("rate_limit_wait", host=host):
+            await limiter.acquire(url)
+    if concurrency is not None:
+        slot_context = concurrency.slot(url)
+    else:
+        slot_context = contextlib.nullcontext(Slot())
+    async with slot_context as slot:
+        start = time.perf_counter()
+        async with session.get(url) as response:
+            headers_at = time.perf_counter()
+            status = response.status
+            slot.status, slot.latency = status, headers_at - start
+            truncated = False
+            if consumer is not None and status == 200:
+                chunks = []
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK):
+                    chunks.append(chunk)
+                    if consumer.feed(chunk):
+                        truncated = True
+                        # Closes the connection rather than reading the rest
+                        response.close()
+                        break
+                body = b"".join(chunks)
+            else:
+                body = await response.read()
+    metrics.observe("ttfb_seconds", headers_at - start, host=host)
+    metrics.observe("download_seconds", time.perf_counter() - headers_at, host=host)
+    metrics.inc("responses_total", host=host, status=status)
+    metrics.inc("response_bytes_total", len(body), host=host)
+    if truncated:
+        metrics.inc("truncated_responses_total", host=host)
+    elif cache is not None and status in (200, 404):
+        cache.put(url, status, body)
+    return status, body
@@ -1,59 +1,303 @@
 import requests
 import json
-from tenacity import Retrying, retry_if_exception_type, wait_fixed
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+from tenacity import RetryError, Retrying, retry_if_exception_type, stop_after_attempt
 import urllib3
 from loguru import logger
 
+from metrics import metrics, timed, count_retry
+
+GRAPH_URL = "https://graph.facebook.com/v7.0/"
+# Maximum number of requests the Graph API accepts in one batch
+MAX_BATCH_SIZE = 50
+# Result for URLs whose request failed, as opposed to None for URLs the API
+# returned an error for; they should be tried again later
+FAILED = "failed"
+# Attempts at a request, rate limited ones included, before its URLs fail
+MAX_ATTEMPTS = 10
+# Attempts at a URL whose batch item comes back null before it fails
+MAX_NULL_ATTEMPTS = 3
+
 
 class RateLimitError(Exception):
     pass
 
 
-class GraphClient:
-    def __init__(self, tokens):
+class BatchTimeoutError(Exception):
+    """Batch items came back null, as the API didn't get to them in time."""
+
+
+def is_rate_limited(data):
+    return (
+        "error" in data
+        and "Application request limit reached" in data["error"]["message"]
+    )
+
+
+def response_rate_limited(data):
+    if isinstance(data, dict):
+        return is_rate_limited(data)
+    # Batch responses carry an error per item
+    return any(
+        item and "Application request limit reached" in item.get("body", "")
+        for item in data
+    )
+
+
+def parse_engagement(data):
+    if is_rate_limited(data):
+        raise RateLimitError
+    elif "error" in data:
+        return None
+    return {**{"url": data["id"]}, **data["engagement"]}
+
+
+def usage_from_headers(headers):
+    """Return (usage percentage, seconds until access is regained) from the
+    X-App-Usage and X-Business-Use-Case-Usage response headers."""
+    usage, regain = 0, 0
+    reports = []
+    if "X-App-Usage" in headers:
+        reports.append(json.loads(headers["X-App-Usage"]))
+    if "X-Business-Use-Case-Usage" in headers:
+        for entries in json.loads(headers["X-Business-Use-Case-Usage"]).values():
+            reports.extend(entries)
+    for report in reports:
+        usage = max(
+            usage,
+            report.get("call_count", 0),
+            report.get("total_cputime", 0),
+            report.get("total_time", 0),
+        )
+        regain = max(regain, 60 * report.get("estimated_time_to_regain_access", 0))
+    return usage, regain
+
+
+class TokenPool:
+    """Hands out access tokens to concurrent requests, least used first.
+
+    Each token's usage is updated from the usage headers of its responses.
+    A token is set aside once its usage reaches `threshold` percent, or when
+    it hits the rate limit, until the API's reported regain time (or
+    `cooldown` seconds if none is reported) has passed. When every token is
+    set aside, acquire() sleeps until the earliest one becomes available.
+    """
+
+    def __init__(self, tokens, threshold=90, cooldown=600):
         self.tokens = tokens
-        self.current_token = 0
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.usage = {token: 0 for token in tokens}
+        self.in_flight = {token: 0 for token in tokens}
+        self.issued = {token: 0 for token in tokens}
+        self.blocked_until = {token: 0 for token in tokens}
+        self.lock = threading.Lock()
 
-    def _get_token(self):
-        return self.tokens[self.current_token]
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                available = [
+                    token for token in self.tokens if self.blocked_until[token] <= now
+                ]
+                if available:
+                    token = min(
+                        available,
+                        key=lambda token: (
+                            self.usage[token],
+                            self.in_flight[token],
+                            self.issued[token],
+                        ),
+                    )
+                    self.in_flight[token] += 1
+                    self.issued[token] += 1
+                    return token
+                wait = min(self.blocked_until.values()) - now
+            logger.info("All tokens near their limit, waiting %.0fs" % wait)
+            metrics.inc("graph_token_wait_seconds_total", wait)
+            time.sleep(wait)
 
-    def _switch_token(self, retry_state):
-        self.current_token += 1
-        self.current_token = self.current_token % len(self.tokens)
+    def release(self, token, headers=None, rate_limited=False):
+        with self.lock:
+            self.in_flight[token] -= 1
+            regain = 0
+            if headers:
+                try:
+                    self.usage[token], regain = usage_from_headers(headers)
+                except (ValueError, AttributeError):
+                    pass
+            index = self.tokens.index(token)
+            metrics.set("graph_token_usage", self.usage[token], token=index)
+            if rate_limited:
+                metrics.inc("graph_rate_limited_total", token=index)
+            if rate_limited or self.usage[token] >= self.threshold:
+                logger.debug(
+                    "Token %s at %s%% usage, backing off" % (index, self.usage[token])
+                )
+                # Requests switch over to the remaining tokens from here on
+                metrics.inc("graph_token_switches_total", token=index)
+                self.blocked_until[token] = time.time() + (regain or self.cooldown)
+                # Usage is reported again on the first response after the reset
+                self.usage[token] = 0
 
-    def get_engagement(self, url):
-        r = Retrying(
+
+class GraphClient:
+    def __init__(
+        self,
+        tokens,
+        pool_size=10,
+        usage_threshold=90,
+        cooldown=600,
+        graph_url=GRAPH_URL,
+    ):
+        self.tokens = tokens
+        self.graph_url = graph_url
+        self.pool = TokenPool(tokens, usage_threshold, cooldown)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _wait(self, retry_state):
+        # A rate limited token has been set aside in the pool already, so the
+        # retry can go straight out on another one
+        if isinstance(retry_state.outcome.exception(), RateLimitError):
+            return 0
+        return 5
+
+    def _retrying(self):
+        return Retrying(
             retry=retry_if_exception_type(
                 (
                     RateLimitError,
+                    BatchTimeoutError,
                     OSError,
                     requests.exceptions.ConnectionError,
                     urllib3.exceptions.MaxRetryError,
                     urllib3.exceptions.NewConnectionError,
                 )
             ),
-            before_sleep=self._switch_token,
-            wait=wait_fixed(5),
+            wait=self._wait,
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            before_sleep=count_retry("graph"),
         )
-        return r.call(self.api_call, url)
 
+    def get_engagement(self, url):
+        try:
+            return self._retrying()(self.api_call, url)
+        except RetryError:
+            logger.warning("Giving up on %s after %s attempts" % (url, MAX_ATTEMPTS))
+            return FAILED
+
+    def get_engagement_many(self, urls):
+        """Look up engagement for up to MAX_BATCH_SIZE URLs in one batch request.
+
+        Returns a list aligned with `urls`, holding None for URLs the API
+        returned an error for and FAILED for those whose request failed.
+        URLs that hit the rate limit are retried on the next token while the
+        results already received are kept. URLs the API didn't get to in time
+        are retried after a pause, up to MAX_NULL_ATTEMPTS times.
+        """
+        results = {}
+        pending = list(urls)
+        null_attempts = Counter()
+
+        def call():
+            limited, timed_out = self.batch_call(pending, results)
+            null_attempts.update(timed_out)
+            timed_out = [
+                url for url in timed_out if null_attempts[url] < MAX_NULL_ATTEMPTS
+            ]
+            pending[:] = limited + timed_out
+            if limited:
+                raise RateLimitError
+            if timed_out:
+                raise BatchTimeoutError
+
+        try:
+            self._retrying()(call)
+        except RetryError:
+            logger.warning(
+                "Giving up on %s URLs after %s attempts" % (len(pending), MAX_ATTEMPTS)
+            )
+        return [results.get(url, FAILED) for url in urls]
+
+    def request(self, method, **kwargs):
+        """Send a request to the Graph API with a token from the pool.
+
+        Returns the decoded JSON, or None if the response isn't JSON.
+        """
+        token = self.pool.acquire()
+        resp = None
+        data = None
+        try:
+            kwargs.setdefault("params", {})["access_token"] = token
+            resp = self.session.request(method, self.graph_url, **kwargs)
+            metrics.inc("responses_total", host="graph", status=resp.status_code)
+            data = json.loads(resp.text)
+        except ValueError:
+            pass
+        finally:
+            self.pool.release(
+                token,
+                resp.headers if resp is not None else None,
+                data is not None and response_rate_limited(data),
+            )
+        return data
+
+    @timed("graph.api_call")
     def api_call(self, url):
-        URL = "https://graph.facebook.com/v7.0/"
+        data = self.request("GET", params={"fields": "engagement", "id": url})
+        if data is None:
+            return FAILED
+        return parse_engagement(data)
+
+    @timed("graph.batch_call")
+    def batch_call(self, urls, results):
+        """Send one batch request, storing parsed engagement per URL in `results`.
+
+        Returns the URLs that were rate limited and those the API didn't get
+        to in time, both to be retried. URLs left out of `results` failed.
+        """
+        batch = [
+            {
+                "method": "GET",
+                "relative_url": "?" + urlencode({"id": url, "fields": "engagement"}),
+            }
+            for url in urls
+        ]
         parameters = {
-            "fields": "engagement",
-            "access_token": self._get_token(),
-            "id": url,
+            "batch": json.dumps(batch),
+            "include_headers": "false",
         }
-        resp = requests.get(URL, params=parameters)
-        try:
-            data = json.loads(resp.text)
-        except:
-            return None
-        if (
-            "error" in data
-            and "Application request limit reached" in data["error"]["message"]
-        ):
-            raise RateLimitError
-        elif "error" in data:
-            return None
-        return {**{"url": data["id"]}, **data["engagement"]}
+        data = self.request("POST", data=parameters)
+        if data is None:
+            return [], []
+        if isinstance(data, dict):
+            # The whole batch failed, e.g. on the app-level rate limit
+            if is_rate_limited(data):
+                raise RateLimitError
+            logger.warning("Batch of %s URLs failed: %s" % (len(urls), data))
+            return [], []
+        limited = []
+        timed_out = []
+        for url, item in zip(urls, data):
+            # Items the API didn't get to in time come back as null
+            if item is None:
+                timed_out.append(url)
+                continue
+            # Server errors fail the item rather than reject the URL
+            if item.get("code", 200) >= 500:
+                continue
+            try:
+                results[url] = parse_engagement(json.loads(item["body"]))
+            except RateLimitError:
+                limited.append(url)
+            except (KeyError, TypeError, ValueError):
+                logger.warning("Malformed batch response for %s" % url)
+        return limited, timed_out
@@ -0,0 +1,103 @@
+import sqlite3
+import time
+
+COUNTS = ("reaction_count", "comment_count", "share_count", "comment_plugin_count")
+
+
+class EngagementHistory:
+    """Timestamped engagement counts per URL, stored in SQLite as deltas.
+
+    `latest` holds the current counts of every URL, when they were last
+    observed and how fast they grew over the last refresh, in engagement
+    per day. `deltas` gets a row only when a count changed, holding the
+    change since the previous observation, so URLs that stopped growing
+    cost nothing to keep refreshing. The first observation is stored as a
+    delta from zero; series() sums the deltas back up.
+    """
+
+    def __init__(self, path, commit_every=100):
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS latest (url TEXT PRIMARY KEY, "
+            "observed_at REAL, rate REAL, %s)"
+            % ", ".join("%s INTEGER" % count for count in COUNTS)
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS deltas (url TEXT, observed_at REAL, %s)"
+            % ", ".join("%s INTEGER" % count for count in COUNTS)
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS deltas_url ON deltas (url)")
+        self.db.commit()
+
+    def due(self, urls, ttl, now=None):
+        """Return the URLs to query: those never observed, in their given
+        order, then those last observed more than `ttl` seconds ago, fastest
+        growing first."""
+        now = now or time.time()
+        latest = {
+            url: (observed_at, rate)
+            for url, observed_at, rate in self.db.execute(
+                "SELECT url, observed_at, rate FROM latest"
+            )
+        }
+        urls = list(dict.fromkeys(urls))
+        new = [url for url in urls if url not in latest]
+        stale = [url for url in urls if url in latest and now - latest[url][0] > ttl]
+        stale.sort(key=lambda url: latest[url][1] or 0, reverse=True)
+        return new + stale
+
+    def record(self, url, data, now=None):
+        """Store an observation of `url`, with `data` None if the API
+        returned an error for it."""
+        now = now or time.time()
+        row = self.db.execute(
+            "SELECT observed_at, %s FROM latest WHERE url = ?" % ", ".join(COUNTS),
+            (url,),
+        ).fetchone()
+        if data is None:
+            # Still counts as observed, so the URL waits out the TTL
+            counts, rate = (row[1:] if row else (None,) * len(COUNTS)), 0
+        else:
+            counts = tuple(int(data[count]) for count in COUNTS)
+            previous = row[1:] if row and row[1] is not None else (0,) * len(COUNTS)
+            delta = tuple(new - old for new, old in zip(counts, previous))
+            rate = 0
+            if row and row[1] is not None:
+                rate = sum(delta) / max(now - row[0], 1) * 86400
+            if any(delta):
+                self.db.execute(
+                    "INSERT INTO deltas VALUES (?, ?, %s)"
+                    % ", ".join("?" * len(COUNTS)),
+                    (url, now) + delta,
+                )
+        self.db.execute(
+            "INSERT OR REPLACE INTO latest VALUES (?, ?, ?, %s)"
+            % ", ".join("?" * len(COUNTS)),
+            (url, now, rate) + tuple(counts),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def series(self, url):
+        """Return the (observed_at, counts dict) of every change to `url`."""
+        totals = [0] * len(COUNTS)
+        points = []
+        for row in self.db.execute(
+            "SELECT observed_at, %s FROM deltas WHERE url = ? ORDER BY observed_at"
+            % ", ".join(COUNTS),
+            (url,),
+        ):
+            totals = [total + delta for total, delta in zip(totals, row[1:])]
+            points.append((row[0], dict(zip(COUNTS, totals))))
+        return points
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from videoid import video_ids
+
+
+class SeenIds:
+    """Set of video IDs stored as a sorted array of 64-bit hashes.
+
+    Takes 8 bytes per ID and checks whole chunks at once. A false positive
+    needs a 64-bit hash collision, which is negligible at millions of IDs.
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add_new(self, ids):
+        """Add an array of unique IDs, returning those not seen before."""
+        hashes = pd.util.hash_array(ids)
+        new = ~np.isin(hashes, self.hashes, assume_unique=True)
+        self.hashes = np.union1d(self.hashes, hashes[new])
+        return ids[new]
+
+
+def iter_video_ids(sourcefn, column="link", chunksize=100000):
+    """Yield the distinct video IDs linked from a source export, reading it in chunks.
+
+    IDs are extracted with vectorized string operations on each chunk and
+    yielded as soon as the chunk is parsed, in order of first appearance.
+    """
+    seen = SeenIds()
+    for chunk in pd.read_csv(
+        sourcefn, usecols=[column], dtype=str, chunksize=chunksize
+    ):
+        ids = video_ids(chunk[column]).dropna().unique()
+        yield from seen.add_new(np.asarray(ids, dtype=object))
@@ -0,0 +1,68 @@
+"""Combine the outputs of sharded runs into one output, keeping one row per
+video.
+
+Usage:
+  merge.py [--snapshots | --by-url] <targetfn> <shardfn>...
+
+Options:
+  --snapshots  Merge archive.py snapshot outputs, keeping one row per
+               archived copy of each video instead.
+  --by-url     Merge facebook_graph_api.py outputs, keeping one row per URL
+               instead, since every form of link has its own engagement.
+"""
+
+from common import logger, config, load_config
+from videoid import video_ids
+
+
+def read_output(path):
+    import pandas as pd
+
+    if path.rstrip("/").endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def write_output(df, path):
+    import os
+
+    if path.rstrip("/").endswith(".parquet"):
+        os.makedirs(path, exist_ok=True)
+        df.to_parquet(os.path.join(path, "part-merged.parquet"), index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def merge(targetfn, shardfns, snapshots=False, by_url=False):
+    import pandas as pd
+
+    df = pd.concat([read_output(shardfn) for shardfn in shardfns], ignore_index=True)
+    # A video can appear more than once if a run was interrupted between
+    # writing its row and checkpointing it, or if the shard count changed
+    # between runs; keep the last row
+    if by_url:
+        keys = df["url"]
+    else:
+        keys = video_ids(df["url"].astype("string")).fillna(df["url"])
+    if snapshots:
+        keys = keys + " " + df["archiveUrl"]
+    merged = df[~keys.duplicated(keep="last")]
+    logger.info(
+        "Merged %s rows from %s shards into %s rows"
+        % (len(df), len(shardfns), len(merged))
+    )
+    write_output(merged, targetfn)
+
+
+def main(argv=None):
+    load_config(__doc__, argv)
+    merge(
+        config["targetfn"],
+        config["shardfn"],
+        config.get("snapshots", False),
+        config.get("byurl", False),
+    )
+
+
+if __name__ == "__main__":
+    main()
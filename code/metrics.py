@@ -0,0 +1,285 @@
+import asyncio
+import bisect
+import functools
+import json
+import threading
+import time
+
+from common import logger
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    float("inf"),
+)
+
+
+def series_name(name, labels):
+    """Prometheus-style series name, e.g. ttfb_seconds{host="youtube.com"}"""
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % item for item in labels))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total, counts = 0, []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        for bound, count in zip(BUCKETS, self.cumulative()):
+            if count >= q * self.count:
+                return bound
+        return BUCKETS[-1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and latency histograms.
+
+    Series are identified by a name and keyword labels, like Prometheus
+    series. Updates are a dict lookup under a lock, cheap enough for the
+    per-request hot path.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": {
+                    series_name(*key): value for key, value in self.counters.items()
+                },
+                "gauges": {
+                    series_name(*key): value for key, value in self.gauges.items()
+                },
+                "histograms": {
+                    series_name(*key): histogram.summary()
+                    for key, histogram in self.histograms.items()
+                },
+            }
+
+    def prometheus(self):
+        """Render all series in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("%s %s" % (series_name(name, labels), value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append("%s %s" % (series_name(name, labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(BUCKETS, histogram.cumulative()):
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    series = series_name(name + "_bucket", labels + (("le", le),))
+                    lines.append("%s %s" % (series, count))
+                lines.append(
+                    "%s %s" % (series_name(name + "_sum", labels), histogram.sum)
+                )
+                lines.append(
+                    "%s %s" % (series_name(name + "_count", labels), histogram.count)
+                )
+        return "\n".join(lines) + "\n"
+
+
+class Timer:
+    """Context manager observing the time spent in its block, and counting
+    the exceptions escaping it under `<name>_errors_total`."""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(
+            self.name + "_seconds", time.perf_counter() - self.start, **self.labels
+        )
+        if exc_type is not None:
+            self.metrics.inc(
+                self.name + "_errors_total", error=exc_type.__name__, **self.labels
+            )
+
+
+# The process-wide registry everything reports to
+metrics = Metrics()
+
+
+def timed(stage):
+    """Decorator timing each call of a function or coroutine function under
+    stage_seconds{stage=...}."""
+
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with metrics.timer("stage", stage=stage):
+                    return await fn(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with metrics.timer("stage", stage=stage):
+                    return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def count_retry(name):
+    """tenacity before_sleep callback counting retries by exception type."""
+
+    def before_sleep(retry_state):
+        exc = retry_state.outcome.exception()
+        metrics.inc("retries_total", stage=name, error=type(exc).__name__)
+
+    return before_sleep
+
+
+class MetricsExporter:
+    """Exports `metrics` while a script runs.
+
+    With `path`, a snapshot is appended to that file as a JSON line every
+    `interval` seconds and once more on close(). With `port`, the current
+    values are served in the Prometheus text format on
+    http://127.0.0.1:<port>/metrics, unless the port is taken.
+    """
+
+    def __init__(self, path=None, interval=10, port=None):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+        if path:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        if port:
+            self.serve(port)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(metrics.snapshot()) + "\n")
+
+    def serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            logger.warning("Not serving metrics on port %s: %s" % (port, e))
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def exporter_from_config(config):
+    """Start the exporter configured under 'metrics-file' and 'metrics-port'.
+
+    Shard i of a --shard run serves on 'metrics-port' + i, so the shards of
+    a run can share a host.
+    """
+    port = config.get("metrics-port")
+    if port and config.get("shard"):
+        from shard import parse_shard
+
+        port += parse_shard(config["shard"])[0]
+    return MetricsExporter(
+        config.get("metrics-file"),
+        config.get("metrics-interval", 10),
+        port,
+    )
@@ -0,0 +1,184 @@
+"""Convert the raw strings scraped from watch pages into numbers and dates.
+
+Usage:
+  normalize.py [--chunksize=<n>] <sourcefn> <targetfn>
+
+Options:
+  --chunksize=<n>  Rows normalized at a time [default: 100000].
+
+Reads a youtube.py or archive.py output (CSV or Parquet) and writes it with
+viewCount and subscriberCount as integers, duration in seconds, and
+publishedAt, scrapedAt and removalAt as datetimes. Values that can't be
+parsed become empty.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from common import config, load_config
+from metrics import metrics
+
+# Arrow types of the normalized columns, for output.make_schema
+TYPES = {
+    "viewCount": "int64",
+    "subscriberCount": "int64",
+    "duration": "int64",
+    "publishedAt": "timestamp[s]",
+    "scrapedAt": "timestamp[s]",
+    "removalAt": "timestamp[s]",
+}
+
+# Abbreviated counts, as in "12.3K subscribers" or "1.2M views"
+SCALES = {"K": 1e3, "M": 1e6, "B": 1e9}
+ABBREVIATED = r"(\d+(?:[.,]\d+)?)\s*([KMB])\b"
+# Abbreviations other than SCALES, e.g. "2,5 Mio." or "12万"
+OTHER_SCALES = ("k", "Mio", "Mrd", "Tsd", "mil", "mln", "mld", "万", "億", "тыс", "млн")
+# Whole counts, either plain digits or grouped in thousands ("1,234,567",
+# "1.234.567", "1 234 567"). Decimals and other abbreviations don't match,
+# so they come out empty rather than as a wrong number.
+COUNT = (
+    r"(?<![\d.,])(\d{1,3}(?:[,.\u00a0\u202f ]\d{3})+|\d+)(?![.,]?\d)"
+    r"(?!\s*(?:%s)(?![a-z]))" % "|".join(("[KMB]",) + OTHER_SCALES)
+)
+
+# Date formats of dateText and publishDate, each as a pattern capturing the
+# date's parts in order and a strptime format for the parts joined by spaces.
+# Dates in other formats or languages, and relative ones such as
+# "3 hours ago", are left empty.
+DATE_FORMATS = (
+    # 2020-04-16, from the microformat
+    (r"(\d{4})-(\d{2})-(\d{2})", "%Y %m %d"),
+    # Apr 16, 2020, possibly after "Published on", "Premiered" or
+    # "Streamed live on"
+    (r"\b([A-Z][a-z]{2})[a-z]*\.? (\d{1,2}), (\d{4})", "%b %d %Y"),
+    # 16 Apr 2020
+    (r"\b(\d{1,2}) ([A-Z][a-z]{2})[a-z]*\.? (\d{4})", "%d %b %Y"),
+    # 16.04.2020
+    (r"\b(\d{1,2})\.(\d{1,2})\.(\d{4})", "%d %m %Y"),
+    # 2020/04/16
+    (r"\b(\d{4})/(\d{1,2})/(\d{1,2})", "%Y %m %d"),
+)
+
+# ISO-8601 durations such as PT25M41S or P1DT2H
+DURATION = r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)(?:\.\d+)?S)?)?$"
+DURATION_SECONDS = np.array([86400, 3600, 60, 1])
+
+
+def as_text(values):
+    return pd.Series(values).astype("string").str.strip()
+
+
+def parse_counts(values):
+    """Counts such as "1,234,567 views", "1.234.567 Aufrufe", "123K",
+    "No views" or subscriberCountText fragments, as Int64."""
+    text = as_text(values)
+    digits = text.str.extract(COUNT, expand=False).str.replace(r"\D+", "", regex=True)
+    counts = digits.astype("Float64")
+    counts = counts.mask(counts.isna() & text.str.match(r"No\b", na=False), 0)
+    abbreviated = text.str.contains(r"\d\s*[KMB]\b", na=False)
+    if abbreviated.any():
+        parts = text[abbreviated].str.extract(ABBREVIATED)
+        mantissa = parts[0].str.replace(",", ".", regex=False).astype("Float64")
+        counts[abbreviated] = mantissa * parts[1].map(SCALES)
+    return counts.round().astype("Int64")
+
+
+def parse_dates(values):
+    """Dates of publishedAt, in the formats of DATE_FORMATS, as datetimes."""
+    text = as_text(values)
+    dates = pd.Series(pd.NaT, index=text.index, dtype="datetime64[s]")
+    for pattern, date_format in DATE_FORMATS:
+        # Each format is only tried on the values no earlier one parsed
+        pending = dates.isna() & text.notna()
+        if not pending.any():
+            break
+        parts = text[pending].str.extract(pattern)
+        joined = parts[0].str.cat(
+            [parts[column] for column in parts.columns[1:]], sep=" "
+        )
+        parsed = pd.to_datetime(joined, format=date_format, errors="coerce")
+        dates[pending] = parsed.astype("datetime64[s]")
+    return dates
+
+
+def parse_durations(values):
+    """ISO-8601 durations, as Int64 seconds."""
+    parts = as_text(values).str.extract(DURATION)
+    matched = parts.notna().any(axis=1)
+    seconds = parts.astype("float64").fillna(0).to_numpy() @ DURATION_SECONDS
+    return pd.Series(seconds, index=parts.index).where(matched).astype("Int64")
+
+
+def parse_timestamps(values):
+    """14-digit Wayback Machine timestamps, as datetimes."""
+    text = as_text(values)
+    text = text.where(text.str.fullmatch(r"\d{14}", na=False))
+    return pd.to_datetime(text, format="%Y%m%d%H%M%S", errors="coerce").astype(
+        "datetime64[s]"
+    )
+
+
+PARSERS = {
+    "viewCount": parse_counts,
+    "subscriberCount": parse_counts,
+    "duration": parse_durations,
+    "publishedAt": parse_dates,
+    "scrapedAt": parse_timestamps,
+    "removalAt": parse_timestamps,
+}
+
+
+def parse_distinct(parse, values):
+    """Apply `parse` to each distinct value only. Dates, durations and
+    subscriber counts repeat a lot across videos."""
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    parsed = parse(pd.Series(uniques, dtype="string"))
+    return pd.Series(parsed.array.take(codes, allow_fill=True), index=values.index)
+
+
+def normalize(df):
+    """Replace the columns of `df` listed in PARSERS with their parsed
+    values, in place, and return it. Columns that are no longer strings
+    were normalized already and are left alone."""
+    with metrics.timer("normalize"):
+        for column, parse in PARSERS.items():
+            if column in df.columns and pd.api.types.is_string_dtype(df[column]):
+                df[column] = parse_distinct(parse, df[column])
+    metrics.inc("normalized_rows_total", len(df))
+    return df
+
+
+def read_chunks(path, chunksize):
+    if path.rstrip("/").endswith(".parquet"):
+        import pyarrow.dataset as ds
+
+        for batch in ds.dataset(path).to_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(
+            path, dtype=str, keep_default_na=False, chunksize=chunksize
+        )
+
+
+def main(argv=None):
+    load_config(__doc__, argv)
+    sourcefn = config["sourcefn"]
+    targetfn = config["targetfn"]
+    parquet = targetfn.rstrip("/").endswith(".parquet")
+    if parquet:
+        os.makedirs(targetfn, exist_ok=True)
+    for i, chunk in enumerate(read_chunks(sourcefn, int(config["chunksize"]))):
+        chunk = normalize(chunk)
+        if parquet:
+            chunk.to_parquet(
+                os.path.join(targetfn, "part-normalized-%05d.parquet" % i),
+                index=False,
+            )
+        else:
+            chunk.to_csv(targetfn, mode="a" if i else "w", header=not i, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import csv
+import os
+import time
+
+from metrics import metrics
+
+
+class CsvOutput:
+    """Appends records to a CSV file, one row per record."""
+
+    def __init__(self, path, fields, flush_every=100):
+        self.fields = fields
+        self.flush_every = flush_every
+        new = not os.path.isfile(path)
+        self.file = open(path, "a")
+        self.writer = csv.writer(self.file)
+        if new:
+            # headers
+            self.writer.writerow(fields)
+
+    def write(self, record):
+        with metrics.timer("output_write", format="csv"):
+            self.writer.writerow([record[x] for x in self.fields])
+
+    def flush(self):
+        with metrics.timer("output_flush", format="csv"):
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetOutput:
+    """Buffers records column by column and writes them to a Parquet dataset.
+
+    `path` is a directory; every flush writes the buffered records as a new
+    part file, so an interrupted run leaves only complete files behind and a
+    resumed run adds to the same dataset. Read back with
+    pd.read_parquet(path, columns=[...]).
+
+    Records can be dicts or records.Record objects; only the schema's
+    fields are kept, in one list per column, so the buffer holds no
+    per-record dicts.
+
+    With `normalize`, each flush parses the buffered columns listed in
+    normalize.PARSERS into numbers and dates before writing them; the
+    schema should give those columns normalize.TYPES.
+    """
+
+    def __init__(self, path, schema, row_group_size=10000, normalize=False):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.flush_every = row_group_size
+        self.fields = schema.names
+        self.columns = {field: [] for field in self.fields}
+        self.buffered = 0
+        self.normalize = None
+        if normalize:
+            from normalize import normalize
+
+            self.normalize = normalize
+        self.run = time.strftime("%Y%m%d%H%M%S")
+        self.parts = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, record):
+        for field in self.fields:
+            self.columns[field].append(record.get(field))
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        with metrics.timer("output_flush", format="parquet"):
+            if self.normalize:
+                import pandas as pd
+
+                df = self.normalize(pd.DataFrame(self.columns))
+                table = self.pa.Table.from_pandas(
+                    df, schema=self.schema, preserve_index=False
+                )
+            else:
+                table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+            partname = "part-%s-%05d.parquet" % (self.run, self.parts)
+            # Write under a hidden name first so readers never see a partial file
+            tmpfn = os.path.join(self.path, "." + partname)
+            self.pq.write_table(table, tmpfn, row_group_size=self.row_group_size)
+            os.replace(tmpfn, os.path.join(self.path, partname))
+        self.parts += 1
+        self.columns = {field: [] for field in self.fields}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def make_schema(fields, types=None):
+    """Arrow schema for `fields`. Columns are strings unless `types` maps
+    them to an Arrow type name such as "int64"."""
+    import pyarrow as pa
+
+    columns = []
+    for field in fields:
+        if types and field in types:
+            columns.append((field, pa.type_for_alias(types[field])))
+        else:
+            columns.append((field, pa.string()))
+    return pa.schema(columns)
+
+
+def open_output(path, fields, types=None, row_group_size=10000, normalize=False):
+    """Open a Parquet dataset for paths ending in .parquet, a CSV file otherwise.
+
+    `normalize` only applies to Parquet datasets, CSV files keep the raw
+    strings; run normalize.py over them afterwards.
+    """
+    if path.endswith(".parquet"):
+        if normalize:
+            from normalize import TYPES
+
+            types = {**TYPES, **(types or {})}
+        schema = make_schema(fields, types)
+        return ParquetOutput(path, schema, row_group_size, normalize)
+    return CsvOutput(path, fields)
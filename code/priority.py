@@ -0,0 +1,96 @@
+import re
+import time
+
+from common import logger
+from videoid import video_ids
+
+# --deadline durations, e.g. 90m or 2h30m, every part with its unit; a bare
+# number is only accepted on its own, as seconds
+DURATION = re.compile(r"^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?$")
+
+
+def read_scores(path, column):
+    """Score of each video ID in the table at `path`: the sum of `column`
+    over the rows linking the video in any form, or with column "links",
+    the number of those rows.
+
+    The table is a CSV file or Parquet dataset with a "url" column, such as
+    a facebook_graph_api.py output, or a "link" column, such as the source
+    export. Rows that don't link a video are ignored.
+    """
+    import pandas as pd
+
+    parquet = path.rstrip("/").endswith(".parquet")
+    if parquet:
+        import pyarrow.dataset as ds
+
+        names = ds.dataset(path).schema.names
+    else:
+        names = pd.read_csv(path, nrows=0).columns
+    url_column = "url" if "url" in names else "link"
+    columns = [url_column] if column == "links" else [url_column, column]
+    if parquet:
+        df = pd.read_parquet(path, columns=columns)
+    else:
+        df = pd.read_csv(path, usecols=columns, dtype={url_column: str})
+    ids = video_ids(df[url_column].astype("string"))
+    if column == "links":
+        return ids.value_counts()
+    values = pd.to_numeric(df[column], errors="coerce").fillna(0)
+    return values.groupby(ids).sum()
+
+
+def by_priority(urls, scores):
+    """Return `urls` highest score first, the unscored ones last, each in
+    their given order."""
+    import numpy as np
+    import pandas as pd
+
+    urls = pd.Series(list(urls), dtype=object)
+    values = video_ids(urls.astype("string")).map(scores).astype("float64")
+    order = np.argsort(-values.fillna(-np.inf).to_numpy(), kind="stable")
+    logger.info(
+        "Ordered %s videos by priority, %s of them scored" % (len(urls), values.count())
+    )
+    return list(urls.iloc[order])
+
+
+def priority_from_config(config, sourcefn):
+    """Function ordering URLs by the score configured under 'priority', or
+    None when URLs are taken in source order.
+
+    'priority' names the column to rank by, e.g. share_count, read from the
+    table at 'priority-file' (by default `sourcefn`), or "links" to rank by
+    the number of its rows linking each video.
+    """
+    column = config.get("priority")
+    if not column:
+        return None
+    scores = read_scores(config.get("priority-file") or sourcefn, column)
+    return lambda urls: by_priority(urls, scores)
+
+
+def parse_deadline(spec, now=None):
+    """Turn a --deadline, either a duration such as 45m, 2h30m or 3600 (in
+    seconds), or an ISO time such as 2020-05-01T18:00, into a time.time()
+    timestamp."""
+    now = now or time.time()
+    if spec.isdigit():
+        return now + int(spec)
+    m = DURATION.match(spec)
+    if m and spec:
+        hours, minutes, seconds = (int(part or 0) for part in m.groups())
+        return now + hours * 3600 + minutes * 60 + seconds
+    from datetime import datetime
+
+    try:
+        return datetime.fromisoformat(spec).timestamp()
+    except ValueError:
+        raise ValueError("Invalid deadline %r" % spec) from None
+
+
+def deadline_from_config(config):
+    """The --deadline as a timestamp, or None without one."""
+    if not config.get("deadline"):
+        return None
+    return parse_deadline(config["deadline"])
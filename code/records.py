@@ -0,0 +1,74 @@
+import sys
+
+VIDEO_FIELDS = (
+    "status",
+    "title",
+    "description",
+    "publishedAt",
+    "viewCount",
+    "channelId",
+    "duration",
+    "channelUrl",
+    "subscriberCount",
+)
+# Fields with few distinct values across millions of records, such as the
+# handful of removal messages; interning stores each value once
+INTERNED = frozenset(("status", "channelId", "channelUrl"))
+
+
+def is_removal_notice(record):
+    """Whether `record` is a page saying the video is unavailable. The
+    removed-video targets also match live pages whose other targets failed,
+    with a playability status of OK."""
+    return bool(record.status) and 'status":"OK"' not in record.status
+
+
+class Record:
+    """A record with a fixed set of fields, held in slots rather than a
+    per-instance dict.
+
+    Built from a dict of extracted fields (or another record) plus keyword
+    overrides, ignoring keys that aren't fields and filling missing ones
+    with "". Writers read it like a dict, record[field].
+    """
+
+    __slots__ = ()
+
+    def __init__(self, values=None, **overrides):
+        values = values or {}
+        for field in self.__slots__:
+            value = overrides[field] if field in overrides else values.get(field, "")
+            if field in INTERNED and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.as_dict())
+
+
+class VideoRecord(Record):
+    """A video's metadata, or the reason it was removed, from its watch page."""
+
+    __slots__ = ("url",) + VIDEO_FIELDS
+
+
+class SnapshotRecord(Record):
+    """A video's watch page as archived at `scrapedAt` under `archiveUrl`."""
+
+    __slots__ = ("url",) + VIDEO_FIELDS + ("archiveUrl", "scrapedAt")
+
+
+class ArchiveRecord(Record):
+    """A removed video's last archived metadata, and when it was first
+    archived as removed."""
+
+    __slots__ = ("url",) + VIDEO_FIELDS + ("scrapedAt", "removalAt", "archiveUrl")
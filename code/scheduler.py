@@ -0,0 +1,51 @@
+import asyncio
+import itertools
+import time
+
+from common import logger
+from metrics import metrics
+
+
+async def bounded_map(worker, items, concurrency, deadline=None, grace=60):
+    """Run `worker` over `items` with at most `concurrency` calls in flight.
+
+    A new item is started as soon as any running one finishes, so a single
+    slow page never holds up the rest. Results are yielded in completion
+    order. `items` may be any iterable and is consumed lazily.
+
+    With `deadline`, a time.time() timestamp, no item is started after it.
+    The running ones get `grace` more seconds to finish; those still running
+    then are cancelled and yield nothing, so they're retried next run.
+    """
+    items = iter(items)
+    pending = set()
+    stopped = False
+
+    def start(count):
+        nonlocal stopped
+        if deadline is not None and time.time() >= deadline:
+            if not stopped:
+                logger.info("Deadline reached, not starting any more tasks")
+                stopped = True
+            return
+        for item in itertools.islice(items, count):
+            pending.add(asyncio.ensure_future(worker(item)))
+
+    start(concurrency)
+    while pending:
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline + grace - time.time(), 0)
+        done, pending = await asyncio.wait(
+            pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            logger.warning("Deadline passed, cancelling %s tasks" % len(pending))
+            metrics.inc("deadline_cancelled_total", len(pending))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            return
+        start(len(done))
+        for task in done:
+            yield task.result()
@@ -0,0 +1,39 @@
+import os
+import zlib
+
+from videoid import video_key
+
+
+def parse_shard(spec):
+    """Parse a shard given as "i/N", with i counted from 0, into (i, N)."""
+    index, count = (int(part) for part in spec.split("/"))
+    if not 0 <= index < count:
+        raise ValueError("Shard index must be between 0 and %s" % (count - 1))
+    return index, count
+
+
+def in_shard(url, shard):
+    # crc32 rather than hash(), which is salted differently in every process
+    index, count = shard
+    return zlib.crc32(video_key(url).encode("utf-8")) % count == index
+
+
+def shard_path(path, shard):
+    """Insert the shard into a file name: out.csv -> out.shard-0-of-4.csv"""
+    root, ext = os.path.splitext(path.rstrip("/"))
+    return "%s.shard-%s-of-%s%s" % (root, shard[0], shard[1], ext)
+
+
+def apply_shard(config):
+    """Point config's outputs and checkpoint at the shard given by --shard.
+
+    Returns the shard as (i, N), or None when the run isn't sharded.
+    """
+    if not config.get("shard"):
+        return None
+    shard = parse_shard(config["shard"])
+    config["targetfn"] = shard_path(config["targetfn"], shard)
+    for key in ("checkpoint", "snapshots-fn"):
+        if config.get(key):
+            config[key] = shard_path(config[key], shard)
+    return shard
@@ -0,0 +1,51 @@
+import re
+
+# The video ID in any form of YouTube link: youtube.com/watch?v=, with
+# other parameters before or after it and on any host (www., m., music.),
+# youtu.be/, /shorts/, /embed/, /live/ and /v/, and links percent-encoded
+# into redirects. IDs are 11 characters; the ID must not run on, so that
+# truncated or padded IDs don't match.
+VIDEO_ID = (
+    r"(?:"
+    r"(?:/|%2[Ff])watch/?(?:\?|%3[Ff])(?:[^#\s]*?(?:&|%26))?v(?:=|%3[Dd])"
+    r"|youtu\.be(?:/|%2[Ff])"
+    r"|youtube(?:-nocookie)?\.com(?:/|%2[Ff])(?:shorts|embed|live|v)(?:/|%2[Ff])"
+    r")"
+    r"([a-zA-Z0-9_\-]{11})(?:[^a-zA-Z0-9_\-]|$)"
+)
+_VIDEO_ID = re.compile(VIDEO_ID)
+
+WATCH_URL = "https://youtube.com/watch?v="
+
+
+def video_id(url):
+    """Return the ID of the video `url` links to, or "" if it isn't one."""
+    try:
+        m = _VIDEO_ID.search(url)
+    except TypeError:
+        return ""
+    return m.group(1) if m else ""
+
+
+def watch_url(video_id):
+    """The canonical URL of a video, which every stage fetches and caches."""
+    return WATCH_URL + video_id
+
+
+def canonical_url(url):
+    """Return the canonical URL of the video `url` links to, or "" if it
+    isn't one."""
+    yt_id = video_id(url)
+    return watch_url(yt_id) if yt_id else ""
+
+
+def video_key(url):
+    """Key for checkpoints, shards and merges: the video ID, or the URL
+    itself for URLs that aren't videos."""
+    return video_id(url) or (url if isinstance(url, str) else "")
+
+
+def video_ids(urls):
+    """Vectorized video_id() over a pandas Series of URLs, with NaN for
+    those that aren't videos."""
+    return urls.str.extract(VIDEO_ID, expand=False)
@@ -1,27 +1,47 @@
+"""Screen the YouTube videos linked from a social media export, recording
+their metadata or the reason they were removed.
+
+Usage:
+  youtube.py [--debug] [--shard=<i/N>] [--deadline=<when>] <sourcefn> <targetfn>
+
+Options:
+  --shard=<i/N>        Only process the i-th of N hash partitions of the
+                       videos, counting from 0, writing to a per-shard output
+                       file.
+  --deadline=<when>    Stop starting videos after a duration such as 45m or
+                       2h30m, or at an ISO time such as 2020-05-01T18:00. The
+                       running ones get another minute to finish.
+
+Videos are taken in source order, or highest score first with 'priority'
+set, see priority.priority_from_config().
+"""
+
 from common import logger
-from common import config
+from common import config, load_config
+from fetching import make_session, fetch, concurrency_from_config, timeout_from_config
+from cache import cache_from_config
+from checkpoint import checkpoint_from_config
+from output import open_output
+from extractor import ExtractorPool, ScraperError
+from records import VideoRecord, is_removal_notice
+from metrics import metrics, timed, count_retry, exporter_from_config
+from scheduler import bounded_map
+from shard import apply_shard, in_shard
+from priority import priority_from_config, deadline_from_config
+from videoid import video_id, watch_url
 
 import aiohttp
 import asyncio
-import requests
-from lxml import html
-import pandas as pd
-import numpy as np
-import seaborn as sns
-from tqdm import tqdm
-import csv
-
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, RetryError
-from IPython.core import ultratb
-
-import os
-import sys
-import re
 
-sys.excepthook = ultratb.FormattedTB(mode="Verbose", color_scheme="Linux", call_pdb=1)
+from tenacity import (
+    RetryError,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+)
 
-sourcefn = sys.argv[1]
-targetfn = sys.argv[2]
+import json
+from urllib.parse import quote
 
 # Data to be extracted, tuple of XPath and a regexp, applied consecutively
 targets_youtube = {
@@ -85,7 +105,7 @@ targets_youtube_removed = {
     "channelUrl": (),
     "subscriberCount": (),
 }
-targets_youtube_removed = {
+targets_youtube_removed_run2 = {
     "status": (
         "//script[contains(text(),'playabilityStatus\":')]//text()",
         'playabilityStatus":({[^}]+})',
@@ -101,58 +121,115 @@ targets_youtube_removed = {
     "subscriberCount": (),
 }
 
-
-class ScraperError(Exception):
-    pass
+# Lightweight endpoint telling available videos apart, for triage. {url} is
+# replaced with the quoted watch URL and {video_id} with the video's ID.
+OEMBED_URL = "https://www.youtube.com/oembed?format=json&url={url}"
+
+# Set up by configure()
+extractor = None
+cache = None
+controller = None
+timeout = None
+# Parse pages while they download, dropping the rest once the fields are in
+STREAM_PARSE = False
+# Probe endpoint, triage is off when None
+PROBE_URL = None
+
+
+def configure(config):
+    global extractor, cache, controller, timeout, STREAM_PARSE, PROBE_URL
+    extractor = ExtractorPool(
+        [
+            targets_youtube,
+            targets_youtube_run2,
+            targets_youtube_removed,
+            targets_youtube_removed_run2,
+        ],
+        json_first=config.get("json-extraction", True),
+        workers=config.get("parse-workers", 0),
+        kind=config.get("parse-executor", "process"),
+    )
+    cache = cache_from_config(config)
+    controller = concurrency_from_config(config, config.get("concurrency", 32))
+    timeout = timeout_from_config(config)
+    STREAM_PARSE = config.get("stream-parse", STREAM_PARSE)
+    PROBE_URL = config.get("triage-url") or (
+        OEMBED_URL if config.get("triage") else None
+    )
 
 
 class InvalidUrl(Exception):
     pass
 
 
-def valid_url(url):
-    if url == "https://youtube.com/watch?v=":
-        return False
-    if len(url) != 39:
-        return False
-    if "youtube.com/watch" in url or "youtu.be" in url:
-        return True
-    return False
-
-
-def apply_xpath_and_regexp(tree, target):
-    results = {}
-    for title, target in target.items():
-        if not target:
-            results[title] = ""
-            continue
-        xpath, regexp = target
-        data = tree.xpath(
-            xpath, namespaces={"re": "http://exslt.org/regular-expressions"}
-        )
-        if not data:
-            raise ScraperError("URL doesn't contain required data on key '%s'" % title)
-        data = data[0]
-        if regexp and data:
-            match = re.search(regexp, data)
-            if not match:
-                raise ScraperError(
-                    "URL doesn't contain matching regexp for key '%s'" % title
-                )
-            data = match.group(0)
-        results[title] = data
-    return results
-
-
-async def async_scrape(url):
+async def probe(session, url):
+    """Classify a video through the probe endpoint, returning (verdict, data).
+
+    The verdict is "available" for a 200, with the title and channel URL
+    the endpoint returned as data, "invalid" for a 400, and "unknown" for
+    anything else: removed, private or unembeddable videos, or a failed
+    probe.
+    """
+    probe_url = PROBE_URL.format(url=quote(url, safe=""), video_id=video_id(url))
     try:
-        return await scrape(url)
-    except ScraperError:
+        status, body = await fetch(session, probe_url, cache, concurrency=controller)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return "unknown", None
+    if status == 400:
+        return "invalid", None
+    if status != 200:
+        return "unknown", None
+    try:
+        info = json.loads(body)
+    except ValueError:
+        return "unknown", None
+    return "available", VideoRecord(
+        url=url, title=info.get("title", ""), channelUrl=info.get("author_url", "")
+    )
+
+
+async def async_scrape(session, url):
+    """Scrape `url`, returning (url, outcome, data) with data None on failure.
+
+    With triage on, the watch page is only fetched for videos the probe
+    doesn't find available; available videos are recorded with the probe's
+    fields only.
+    """
+    if PROBE_URL:
+        verdict, data = await probe(session, url)
+        metrics.inc("triage_total", verdict=verdict)
+        if verdict == "available":
+            metrics.inc("outcomes_total", stage="youtube", outcome="ok")
+            return url, "ok", data
+        if verdict == "invalid":
+            return url, "invalid", None
+    try:
+        data = await scrape(session, url)
+    except ScraperError as e:
         logger.warning("Unhandled ScraperError for %s" % url)
-        return None
+        metrics.inc("scraper_errors_total", stage="youtube", key=e.key)
+        return url, "error", None
     except InvalidUrl:
         logger.warning("InvalidUrl for %s" % url)
-        return None
+        return url, "invalid", None
+    except (
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+        RetryError,
+        UnicodeDecodeError,
+    ) as e:
+        # Left for the next run rather than ending this one
+        logger.warning("%s for %s" % (type(e).__name__, url))
+        metrics.inc("fetch_errors_total", stage="youtube", error=type(e).__name__)
+        return url, "error", None
+    if data.status and not is_removal_notice(data):
+        # A live page only the removed-video targets matched
+        logger.warning("No metadata found for %s" % url)
+        metrics.inc("scraper_errors_total", stage="youtube", key="playable")
+        return url, "error", None
+    outcome = "removed" if data.status else "ok"
+    metrics.inc("outcomes_total", stage="youtube", outcome=outcome)
+    return url, outcome, data
 
 
 @retry(
@@ -164,94 +241,104 @@ async def async_scrape(url):
             aiohttp.ClientOSError,
         )
     ),
+    before_sleep=count_retry("youtube.scrape"),
 )
-async def scrape(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 404:
-                raise InvalidUrl
-            try:
-                data = extract_targets_from_page(
-                    await response.text(), [targets_youtube, targets_youtube_run2]
-                )
-            except (ScraperError, RetryError):
-                data = extract_targets_from_page(
-                    await response.text(),
-                    [targets_youtube_removed, targets_youtube_removed2],
-                )
-            return {**data, **{"url": url}}
-
-
-@retry(stop=stop_after_attempt(2), retry=retry_if_exception_type(ScraperError))
-def extract_targets_from_page(pagecontent, targets):
-    tree = html.fromstring(pagecontent)
-    if isinstance(targets, dict):
-        targets = [targets]
-
-    for idx, target in enumerate(targets):
-        try:
-            data = apply_xpath_and_regexp(tree, target)
-            break
-        except ScraperError as e:
-            if idx + 1 == len(targets):
-                raise ScraperError(e)
-            else:
-                continue
-    return data
-
-
-def get_yt_link(x):
-    try:
-        m = re.search("(v\=|youtu.be/)([a-zA-Z0-9_\-]+)", x)
-    except TypeError:
-        return ""
-    if not m:
-        return x
-    return "https://youtube.com/watch?v=" + m.groups()[1]
-
-
-def get_yt_id(x):
-    try:
-        m = re.search("(v\=|youtu.be/)([a-zA-Z0-9_\-]+)", x)
-    except TypeError:
-        return ""
-    if not m:
-        return ""
-    return m.groups()[1]
-
-
-df = pd.read_csv(sourcefn)
-df["yt_id"] = df["link"].apply(get_yt_id)
-df["yt_link"] = "https://youtube.com/watch?v=" + df["yt_id"]
+@timed("youtube.scrape")
+async def scrape(session, url):
+    stream = extractor.stream() if STREAM_PARSE else None
+    status, body = await fetch(
+        session, url, cache, concurrency=controller, consumer=stream
+    )
+    if status == 404:
+        raise InvalidUrl
+    if stream is not None:
+        data = await extractor.extract_stream(stream, body)
+    else:
+        data = await extractor.extract(body)
+    return VideoRecord(data, url=url)
+
+
+async def scrape_all(
+    urls, output, checkpoint, concurrency, connections_per_host, deadline=None
+):
+    from tqdm import tqdm
+
+    async with make_session(
+        concurrency, connections_per_host, timeout=timeout
+    ) as session:
+        progress = tqdm()
+        async for url, outcome, data in bounded_map(
+            lambda url: async_scrape(session, url), urls, concurrency, deadline
+        ):
+            progress.update()
+            if data:
+                output.write(data)
+            checkpoint.record(url, outcome)
+        progress.close()
+
+
+def main(argv=None):
+    from ingest import iter_video_ids
+
+    load_config(__doc__, argv)
+    shard = apply_shard(config)
+    configure(config)
+    exporter = exporter_from_config(config)
+    deadline = deadline_from_config(config)
+    sourcefn = config["sourcefn"]
+    targetfn = config["targetfn"]
+
+    # Video IDs are read lazily, so fetching starts once the first chunk is
+    # parsed, unless they're ordered by priority
+    urls = (
+        watch_url(yt_id)
+        for yt_id in iter_video_ids(
+            sourcefn, "link", config.get("ingest-chunksize", 100000)
+        )
+    )
+    fields = ["url"] + list(targets_youtube.keys())
+
+    output = open_output(
+        targetfn,
+        fields,
+        row_group_size=config.get("row-group-size", 10000),
+        normalize=config.get("normalize", False),
+    )
+    checkpoint = checkpoint_from_config(
+        config,
+        "youtube",
+        targetfn,
+        commit_every=output.flush_every,
+        before_commit=output.flush,
+    )
+
+    urls = (
+        url
+        for url in urls
+        if (shard is None or in_shard(url, shard)) and url not in checkpoint
+    )
+    order = priority_from_config(config, sourcefn)
+    if order is not None:
+        urls = order(urls)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        scrape_all(
+            urls,
+            output,
+            checkpoint,
+            config.get("concurrency", 32),
+            config.get("connections-per-host", 0),
+            deadline,
+        )
+    )
+    checkpoint.close()
+    output.close()
+    extractor.shutdown()
+    if cache is not None:
+        cache.close()
+    exporter.close()
 
-urls = list(df["yt_link"].unique())
-fields = ["url"] + list(targets_youtube.keys())
 
-if os.path.isfile(targetfn):
-    try:
-        current_data = pd.read_csv(targetfn)
-        read_urls = current_data["url"].values
-    except pd.errors.EmptyDataError:
-        read_urls = []
-else:
-    read_urls = []
-    # headers
-    with open(targetfn, "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(fields)
-
-BATCHSIZE = 32
-loop = asyncio.get_event_loop()
-
-urls = list(set(urls) - set(read_urls))
-
-with open(targetfn, "a") as f:
-    writer = csv.writer(f)
-    for url_range in tqdm(range(0, len(urls), BATCHSIZE)):
-        url_batch = urls[url_range : url_range + BATCHSIZE]
-        url_batch = [url for url in url_batch if url and valid_url(url)]
-        if url_batch:
-            coroutines = [async_scrape(url) for url in url_batch]
-            results = loop.run_until_complete(asyncio.gather(*coroutines))
-            for data in [res for res in results if res]:
-                writer.writerow([data[x] for x in fields])
\ No newline at end of file
+if __name__ == "__main__":
+    main()